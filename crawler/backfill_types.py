@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Fill yamap_pois_types / yamareco_pois_types from poi_type_raw of the POIs
+# crawled before the types table existed. New crawls keep it up to date.
+
+from argparse import ArgumentParser
+
+from crawler import SITES
+from crawler_utils import CrawlerDB
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("site_name", choices=SITES.keys(), help="Site to backfill")
+    parser.add_argument(
+        "--batch-size", type=int, default=5000, help="POIs per transaction"
+    )
+    args = parser.parse_args()
+    site = SITES[args.site_name.lower()]
+
+    with CrawlerDB(
+        pois_table=site["pois_table"], queue_table=site["queue_table"]
+    ) as db:
+        db.create_tables_if_not_exist()
+        count = db.backfill_types(args.batch_size)
+
+    print(f"[*] Total backfilled POIs: {count}")
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Throughput benchmark: run crawler.py against a local fake_site.py server
+# and report IDs/sec, request latency and DB write cost.
+# Crawls into <site>_pois<suffix> / <site>_queue<suffix>, which are truncated
+# first. Unknown options are passed on to crawler.py, e.g.
+#   ./bench_crawler.py yamap --step 3000 --latency 0.1 --gap-rate 0.1 --concurrency 8
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fake_site import add_site_arguments, serve, site_from_args
+
+CRAWLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crawler.py")
+
+
+def ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:g} ms"
+
+
+def report(metrics, wall_time):
+    latency = metrics["request_latency_seconds"]
+    flush = metrics["db_flush_seconds"]
+    n_checked = sum(metrics["status"].values())
+    n_rows = metrics["db_rows_flushed"]
+    print(f"[*] IDs checked: {n_checked} in {wall_time:.2f} s (wall clock)")
+    print(f"[*] IDs/sec: {metrics['ids_per_second_total']:.2f}")
+    print(
+        f"[*] Request latency: p50 <= {ms(latency['p50'])}, p99 <= {ms(latency['p99'])}"
+        f" ({latency['count']} requests)"
+    )
+    print(f"[*] HTTP status: {json.dumps(metrics['http_status'], sort_keys=True)}")
+    print(
+        "[*] Queue status: "
+        + json.dumps({k: v for k, v in metrics["status"].items() if v})
+    )
+    if n_checked:
+        print(f"[*] Bytes read per ID: {metrics['bytes_total'] / n_checked:.0f}")
+    if flush["count"]:
+        print(
+            f"[*] DB flushes: {flush['count']}, {flush['sum']:.3f} s total,"
+            f" p99 <= {ms(flush['p99'])}, {flush['sum'] / n_rows * 1e6:.0f} us per row"
+        )
+    if metrics["target_rate"] is not None:
+        print(f"[*] Final target rate: {metrics['target_rate']:g} req/s")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("site_name", choices=["yamap", "yamareco"], help="Site")
+    parser.add_argument("--step", type=int, default=2000, help="IDs to crawl")
+    parser.add_argument(
+        "--table-suffix", default="_bench", help="Suffix of the scratch tables"
+    )
+    add_site_arguments(parser)
+    args, crawler_args = parser.parse_known_args()
+    if not args.table_suffix:
+        print("[!] Refusing to benchmark on the production tables.")
+        return
+
+    server = serve(site_from_args(args))
+    host, port = server.server_address[:2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metrics_path = os.path.join(tmp_dir, "metrics.json")
+        tables = ["--table-suffix", args.table_suffix]
+        subprocess.run(
+            [sys.executable, CRAWLER, args.site_name, "--truncate", "--step", "1"]
+            + tables,
+            check=True,
+        )
+        command = [
+            sys.executable,
+            CRAWLER,
+            args.site_name,
+            "--step",
+            str(args.step),
+            "--base-url",
+            f"http://{host}:{port}",
+            *tables,
+            "--metrics",
+            metrics_path,
+            "--owner",
+            "bench",
+            *crawler_args,
+        ]
+        print("[*] " + " ".join(command[1:]))
+        start = time.monotonic()
+        subprocess.run(command, check=True)
+        wall_time = time.monotonic() - start
+        server.shutdown()
+        with open(metrics_path, encoding="utf-8") as f:
+            metrics = json.load(f)
+
+    report(metrics, wall_time)
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
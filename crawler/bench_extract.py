@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark: full-page regex vs streaming __NEXT_DATA__ extraction
+# on saved yamap landmark pages (e.g. curl -o 12345.html https://yamap.com/landmarks/12345)
+
+import json
+import re
+import time
+from argparse import ArgumentParser
+
+from http_util import CHUNK_SIZE, extract_next_data
+
+
+def extract_regex(body):
+    text = body.decode("utf-8")
+    m = re.search(
+        r'<script id="__NEXT_DATA__" type="application/json">(.+?)</script>', text
+    )
+    return json.loads(m.group(1)) if m else None, len(body)
+
+
+def extract_streaming(body):
+    chunks = (body[i : i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+    payload, n_read = extract_next_data(chunks)
+    return json.loads(payload) if payload else None, n_read
+
+
+def measure(func, body, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        data, n_read = func(body)
+    return data, n_read, (time.process_time() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("html_files", nargs="+", help="Saved landmark pages")
+    parser.add_argument("--repeat", type=int, default=200, help="Runs per page")
+    args = parser.parse_args()
+
+    totals = {"regex": [0, 0.0], "streaming": [0, 0.0]}
+    print("file\tsize\tregex_bytes\tregex_us\tstream_bytes\tstream_us")
+    for path in args.html_files:
+        with open(path, "rb") as f:
+            body = f.read()
+        data1, bytes1, cpu1 = measure(extract_regex, body, args.repeat)
+        data2, bytes2, cpu2 = measure(extract_streaming, body, args.repeat)
+        assert data1 == data2, f"extractors disagree on {path}"
+        totals["regex"][0] += bytes1
+        totals["regex"][1] += cpu1
+        totals["streaming"][0] += bytes2
+        totals["streaming"][1] += cpu2
+        print(
+            f"{path}\t{len(body)}\t{bytes1}\t{cpu1 * 1e6:.1f}\t{bytes2}\t{cpu2 * 1e6:.1f}"
+        )
+
+    n = len(args.html_files)
+    for name, (n_bytes, cpu) in totals.items():
+        print(
+            f"[*] {name}: {n_bytes / n:.0f} bytes read, {cpu / n * 1e6:.1f} us CPU per landmark"
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
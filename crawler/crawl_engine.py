@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from http_util import USER_AGENT, TokenBucket
+
+
+class CrawlEngine:
+    # Keeps up to `concurrency` requests in flight under a token bucket
+    # (a fixed TokenBucket or an adaptive RateController).
+    # fetch_func(session, target_id) runs in a worker thread; its results are
+    # handed to on_result(target_id, data, status) in dispatch order, so the
+    # caller sees the same sequence as the old one-at-a-time loop.
+    # on_result returns False to stop the crawl; later results are discarded.
+    def __init__(self, fetch_func, on_result, bucket=None, concurrency=1, timeout=0):
+        self.fetch_func = fetch_func
+        self.on_result = on_result
+        self.bucket = bucket or TokenBucket(0)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.closing = False  # no more dispatch, finish in-flight requests
+        self.stopped = False  # discard everything not yet handed over
+        self.n_dispatched = 0
+        self.n_done = 0
+        self.pending = {}
+
+    def run(self, ids):
+        asyncio.run(self._run(iter(ids)))
+
+    async def _run(self, ids):
+        self.start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            workers = [self._worker(executor, ids) for _ in range(self.concurrency)]
+            await asyncio.gather(*workers)
+
+    def _next_id(self, ids):
+        if self.closing or self.stopped:
+            return None
+        elapsed_time = time.time() - self.start_time
+        if self.timeout > 0 and elapsed_time >= self.timeout:
+            print(
+                f"[*] Timeout reached after {elapsed_time:.2f} seconds. Stopping crawler."
+            )
+            self.closing = True
+            return None
+        target_id = next(ids, None)
+        if target_id is None:
+            self.closing = True
+        return target_id
+
+    async def _worker(self, executor, ids):
+        loop = asyncio.get_running_loop()
+        with requests.Session() as session:
+            session.headers.update({"User-Agent": USER_AGENT})
+            while (target_id := self._next_id(ids)) is not None:
+                seq = self.n_dispatched
+                self.n_dispatched += 1
+                delay = self.bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.stopped:
+                    break
+                data, status = await loop.run_in_executor(
+                    executor, self.fetch_func, session, target_id
+                )
+                self.pending[seq] = (target_id, data, status)
+                self._drain()
+
+    def _drain(self):
+        while self.n_done in self.pending:
+            target_id, data, status = self.pending.pop(self.n_done)
+            self.n_done += 1
+            if self.stopped:
+                continue
+            if not self.on_result(target_id, data, status):
+                self.stopped = True
+
+
+# __END__
@@ -2,34 +2,103 @@
 # -*- coding: utf-8 -*-
 
 import json
-import re
-import time
-from argparse import ArgumentParser
+import os
+import socket
+from argparse import ArgumentParser, BooleanOptionalAction
 from datetime import datetime, timezone
+from functools import partial
+from itertools import islice
 
 import requests
 
+from crawl_engine import CrawlEngine
 from crawler_utils import CrawlerDB
-from http_util import USER_AGENT, get_with_retry, post_with_retry
+from metrics import CrawlerMetrics
+from raw_archive import RawArchive
+from http_util import (
+    CHUNK_SIZE,
+    USER_AGENT,
+    RateController,
+    extract_next_data,
+    get_with_retry,
+    post_with_retry,
+)
 
+YAMAP_BASE_URL = "https://yamap.com"
+YAMARECO_BASE_URL = "https://api.yamareco.com"
 
-def fetch_yamap_data(session, target_id):
-    url = f"https://yamap.com/landmarks/{target_id}"
+
+# Both fetchers return (data, status). In refresh mode `validators` holds the
+# stored content hash and HTTP validators; (None, STATUS_SUCCESS) then means
+# the landmark is unchanged. With an `archive`, the raw payload is stored
+# before parsing so the tables can be rebuilt offline (see reparse.py).
+
+
+def failure_status(code):
+    # queue status of a failed request_with_retry() code; only network errors
+    # and rate limits are retried by claim_ids
+    return {
+        2: CrawlerDB.STATUS_NOT_FOUND,
+        3: CrawlerDB.STATUS_INVALID,
+        -2: CrawlerDB.STATUS_RATE_LIMIT,
+    }.get(code, CrawlerDB.STATUS_NETWORK_ERROR)
+
+
+def fetch_yamap_data(
+    session,
+    target_id,
+    base_url=YAMAP_BASE_URL,
+    validators=None,
+    controller=None,
+    archive=None,
+    metrics=None,
+):
+    url = f"{base_url}/landmarks/{target_id}"
+    headers = {}
+    if validators:
+        if validators.get("http_etag"):
+            headers["If-None-Match"] = validators["http_etag"]
+        if validators.get("http_last_modified"):
+            headers["If-Modified-Since"] = validators["http_last_modified"]
     res, code = get_with_retry(
-        session, url
-    )  # code: 0=success, -1=network error, -2=rate limit
-    if code < 0:
-        return None, (
-            CrawlerDB.STATUS_RATE_LIMIT
-            if code == -2
-            else CrawlerDB.STATUS_NETWORK_ERROR
-        )
-    m = re.search(
-        r'<script id="__NEXT_DATA__" type="application/json">(.+?)</script>', res.text
-    )
-    if not m:
+        session,
+        url,
+        headers=headers,
+        controller=controller,
+        stream=True,
+        metrics=metrics,
+    )  # code: 0=success, 1=not modified, 2=not found, 3=client error, <0=retry later
+    if code not in (0, 1):
+        return None, failure_status(code)
+    if code == 1:
+        res.close()
+        return None, CrawlerDB.STATUS_SUCCESS
+    # read only up to the end of __NEXT_DATA__, then drop the connection
+    with res:
+        try:
+            payload, n_read = extract_next_data(res.iter_content(CHUNK_SIZE))
+        except requests.RequestException as e:
+            # the connection dropped mid-body: retry the ID later
+            print(f"Request error: {e}")
+            if controller:
+                controller.on_error()
+            return None, CrawlerDB.STATUS_NETWORK_ERROR
+    if metrics:
+        metrics.observe_bytes(n_read)
+    if payload and archive:
+        archive.store("yamap", target_id, payload)
+    data, status = parse_yamap_data(target_id, payload)
+    if data:
+        data["http_etag"] = res.headers.get("ETag")
+        data["http_last_modified"] = res.headers.get("Last-Modified")
+    return data, status
+
+
+def parse_yamap_data(target_id, payload):
+    # payload: the __NEXT_DATA__ JSON of a landmark page
+    if not payload:
         return None, CrawlerDB.STATUS_INVALID
-    data = json.loads(m.group(1))
+    data = json.loads(payload)
     landmark = data.get("props", {}).get("pageProps", {}).get("restLandmark")
     if not landmark:
         return None, CrawlerDB.STATUS_INVALID
@@ -53,23 +122,38 @@ def fetch_yamap_data(session, target_id):
     }, CrawlerDB.STATUS_SUCCESS
 
 
-def fetch_yamareco_data(session, target_id):
-    url = "https://api.yamareco.com/api/v1/searchPoi"
+def fetch_yamareco_data(
+    session,
+    target_id,
+    base_url=YAMARECO_BASE_URL,
+    validators=None,
+    controller=None,
+    archive=None,
+    metrics=None,
+):
+    # searchPoi is a POST API without conditional requests,
+    # so unchanged records are only detected by their content hash
+    url = f"{base_url}/api/v1/searchPoi"
     payload = {
         "page": 1,
         "type_id": 0,
         "ptid": target_id,
     }
     res, code = post_with_retry(
-        session, url, payload
-    )  # code: 0=success, -1=network error, -2=rate limit
-    if code < 0:
-        return None, (
-            CrawlerDB.STATUS_RATE_LIMIT
-            if code == -2
-            else CrawlerDB.STATUS_NETWORK_ERROR
-        )
-    data = res.json()
+        session, url, payload, controller=controller, metrics=metrics
+    )  # code: 0=success, 2=not found, 3=client error, <0=retry later
+    if code != 0:
+        return None, failure_status(code)
+    if metrics:
+        metrics.observe_bytes(len(res.content))
+    if archive:
+        archive.store("yamareco", target_id, res.content)
+    return parse_yamareco_data(target_id, res.content)
+
+
+def parse_yamareco_data(target_id, payload):
+    # payload: the searchPoi JSON response
+    data = json.loads(payload)
     if data.get("err") != 0:
         return None, CrawlerDB.STATUS_INVALID
     poilist = data.get("poilist", [])
@@ -90,101 +174,398 @@ def fetch_yamareco_data(session, target_id):
     }, CrawlerDB.STATUS_SUCCESS
 
 
+# CONFIG: per-site request budget
+SITES = {
+    "yamap": {
+        "pois_table": "yamap_pois",
+        "queue_table": "yamap_queue",
+        "fetch_func": fetch_yamap_data,
+        "parse_func": parse_yamap_data,
+        "rate": 5.0,  # initial requests/sec, adjusted by RateController
+        "max_rate": 20.0,
+        "concurrency": 4,  # requests in flight
+    },
+    "yamareco": {
+        "pois_table": "yamareco_pois",
+        "queue_table": "yamareco_queue",
+        "fetch_func": fetch_yamareco_data,
+        "parse_func": parse_yamareco_data,
+        "rate": 5.0,
+        "max_rate": 20.0,
+        "concurrency": 4,
+    },
+}
+
+
+def estimate_frontier(
+    is_live, start, window=16, samples=4, lookahead=4, max_step=1 << 20
+):
+    # Highest live ID past `start` (a known live ID), found with a couple of
+    # hundred probes instead of running into --max-failures misses.
+    # A probe samples `samples` IDs of [id, id + window), so deleted-ID gaps
+    # shorter than the window do not end the search early. A dead window only
+    # counts as dead if the windows `window << k` (k < lookahead) past it are
+    # dead too, so gaps up to `window << (lookahead - 1)` are crossed as well.
+    # The step doubles while probes are live, then the last live / first dead
+    # pair is bisected down to one window. Returns None if probing failed.
+    def probe(first):
+        for i in range(samples):
+            live = is_live(first + i * window // samples)
+            if live is None or live:
+                return live
+        return False
+
+    def probe_ahead(first):
+        # start of the first live window at or past `first`, False if none
+        for k in range(lookahead + 1):
+            at = first + (window << (k - 1) if k else 0)
+            live = probe(at)
+            if live is None:
+                return None
+            if live:
+                return at
+        return False
+
+    lo, hi, step = start, None, window
+    while hi is None or hi - lo > window:
+        # exponential until a dead window is found, then binary
+        at = lo + step if hi is None else (lo + hi) // 2
+        found = probe_ahead(at)
+        if found is None:
+            return None
+        if found is False:
+            hi = at
+            continue
+        lo = found
+        if hi is not None and lo >= hi:
+            hi = None  # a live ID past the dead window: search further out
+        if hi is None and step < max_step:
+            step *= 2
+    return hi + window - 1
+
+
 def main():
     parser = ArgumentParser()
-    parser.add_argument(
-        "site_name", choices=["yamap", "yamareco"], help="Site to crawl"
-    )
+    parser.add_argument("site_name", choices=SITES.keys(), help="Site to crawl")
     parser.add_argument("--truncate", action="store_true", help="Truncate tables")
     parser.add_argument("--step", type=int, default=0, help="Number of POIs to crawl")
     parser.add_argument(
-        "--max-failures", type=int, default=800, help="Max consecutive failures"
+        "--max-failures",
+        type=int,
+        default=800,
+        help="Max consecutive failures (only without a probed frontier)",
     )
     parser.add_argument(
         "--interval",
         type=float,
-        default=0.5,
-        help="Interval between requests (seconds)",
+        default=0,
+        help="Initial interval between requests (seconds), same as --rate 1/INTERVAL",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Initial requests per second (site default)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=0,
+        help="Upper bound for the adaptive rate (site default)",
+    )
+    parser.add_argument(
+        "--fixed-rate",
+        action="store_true",
+        help="Keep the initial rate instead of adapting it (AIMD)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Max requests in flight (site default)",
+    )
+    parser.add_argument(
+        "--base-url", help="Override the site URL (e.g. a local fake server)"
+    )
+    parser.add_argument(
+        "--timeout", type=int, default=0, help="Request timeout (seconds)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="DB rows buffered per flush"
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=10,
+        help="Max seconds between DB flushes",
+    )
+    parser.add_argument(
+        "--lease-size",
+        type=int,
+        default=100,
+        help="Claim IDs from the queue table in leased blocks of this size"
+        " (lets several crawler processes share a site)",
+    )
+    parser.add_argument(
+        "--lease-ttl", type=int, default=600, help="Lease expiry (seconds)"
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=int,
+        default=60,
+        help="Base backoff before retrying a failed ID (seconds, doubled per retry)",
+    )
+    parser.add_argument(
+        "--max-retries", type=int, default=8, help="Give up on an ID after N errors"
+    )
+    parser.add_argument(
+        "--recheck-after",
+        type=int,
+        default=3600,
+        help="Recheck missing IDs after the last success at most this often (seconds)",
+    )
+    parser.add_argument(
+        "--recheck-window",
+        type=int,
+        default=100,
+        help="Recheck only this many IDs after the last success",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Recrawl already fetched IDs, stalest first, writing only changed ones",
+    )
+    parser.add_argument(
+        "--refresh-age",
+        type=int,
+        default=7 * 24 * 3600,
+        help="Only refresh IDs not checked for this long (seconds)",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Store every raw response (compressed, content-addressed) under this directory",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write metrics to this file (*.json: JSON snapshot, otherwise Prometheus text)",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=15,
+        help="Seconds between metrics file updates",
+    )
+    parser.add_argument(
+        "--frontier",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Probe ahead for the highest live ID and crawl only up to it",
+    )
+    parser.add_argument(
+        "--frontier-window",
+        type=int,
+        default=16,
+        help="Deleted-ID gaps shorter than this do not end the frontier search",
+    )
+    parser.add_argument(
+        "--frontier-samples",
+        type=int,
+        default=4,
+        help="IDs probed per frontier window",
+    )
+    parser.add_argument(
+        "--table-suffix",
+        default="",
+        help="Append to the table names (e.g. _bench for fake_site.py runs)",
+    )
+    parser.add_argument(
+        "--owner",
+        default=f"{socket.gethostname()}:{os.getpid()}",
+        help="Lease owner name",
     )
-    parser.add_argument("--timeout", type=int, default=0, help="Request timeout (seconds)")
     args = parser.parse_args()
     site_name = args.site_name.lower()
     truncate = args.truncate
     step = args.step
     max_failures = args.max_failures
-    interval = args.interval
     timeout = args.timeout
     if not (step > 0 or timeout > 0):
         print("[!] Either --step or --timeout must be greater than 0.")
         return
+    if args.table_suffix and not args.table_suffix.replace("_", "a").isalnum():
+        print("[!] --table-suffix may only contain letters, digits and '_'.")
+        return
 
-    if site_name == "yamareco":
-        pois_table = "yamareco_pois"
-        queue_table = "yamareco_queue"
-        fetch_func = fetch_yamareco_data
+    site = SITES[site_name]
+    rate = args.rate or (1 / args.interval if args.interval > 0 else site["rate"])
+    max_rate = max(rate, args.max_rate or site["max_rate"])
+    concurrency = args.concurrency or site["concurrency"]
+    if args.fixed_rate:  # only Retry-After is honored
+        controller = RateController(rate, increase=0, decrease=1)
     else:
-        pois_table = "yamap_pois"
-        queue_table = "yamap_queue"
-        fetch_func = fetch_yamap_data
+        controller = RateController(rate, min_rate=min(rate, 0.2), max_rate=max_rate)
+    fetch_func = partial(site["fetch_func"], controller=controller)
+    if args.base_url:
+        fetch_func = partial(fetch_func, base_url=args.base_url.rstrip("/"))
+    if args.archive:
+        fetch_func = partial(fetch_func, archive=RawArchive(args.archive))
+    metrics = None
+    if args.metrics:
+        metrics = CrawlerMetrics(site_name, controller)
+        fetch_func = partial(fetch_func, metrics=metrics)
+    refresh = args.refresh
 
-    db = CrawlerDB(pois_table=pois_table, queue_table=queue_table)
+    db = CrawlerDB(
+        pois_table=site["pois_table"] + args.table_suffix,
+        queue_table=site["queue_table"] + args.table_suffix,
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        metrics=metrics,
+    )
     db.create_tables_if_not_exist()
     if truncate:
         db.truncate_tables()
         return
+    if db.types_missing():
+        # exports and the review map select POIs through the types table
+        print(f"[*] Backfilling {db.types_table} from poi_type_raw")
+        db.backfill_types()
+
+    lease_size = max(1, args.lease_size)
+    owner = args.owner
+    if refresh:
+        print(
+            f"[*] Refreshing {site_name} as {owner}"
+            f" ({rate:g} req/s, {concurrency} in flight)"
+        )
+    else:
+        print(
+            f"[*] Crawling {site_name} as {owner}, last successful ID {db.get_max_id()}"
+            f" ({rate:g} req/s, {concurrency} in flight)"
+        )
+    frontier = None
+    if args.frontier and not refresh:
+        last_id = db.get_max_id()
+        n_probes = 0
+
+        def is_live(target_id):
+            # live probes are recorded like crawled IDs, so they are not
+            # fetched again; misses are left to the crawl
+            nonlocal n_probes
+            n_probes += 1
+            controller.acquire()
+            data, status = fetch_func(session, target_id)
+            if status == CrawlerDB.STATUS_RATE_LIMIT:
+                return None
+            if status == CrawlerDB.STATUS_SUCCESS:
+                if data is not None:
+                    db.save_to_database(target_id, data)
+                db.update_queue_status(target_id, status)
+                return True
+            return False
 
-    start = db.get_max_id() + 1
-    print(f"[*] Crawling {site_name} starts from ID {start}")
+        with requests.Session() as session:
+            session.headers.update({"User-Agent": USER_AGENT})
+            frontier = estimate_frontier(
+                is_live,
+                last_id,
+                window=max(1, args.frontier_window),
+                samples=max(1, args.frontier_samples),
+            )
+        if frontier is None:
+            print(f"[!] Frontier probing failed after {n_probes} requests.")
+        else:
+            n_queued = db.enqueue_ids(last_id + 1, frontier)
+            print(
+                f"[*] Estimated frontier: ID {frontier} ({n_probes} probes,"
+                f" {n_queued} IDs queued)"
+            )
     count = 0  # Number of successful entries
-    n_write = 0  # Number of DB writes
+    n_unchanged = 0  # Number of successful entries not rewritten
+    n_checked = 0  # Number of IDs with a recorded status
     n_failures = 0  # Number of consecutive failures
-    target_id = start
-    start_time = time.time()
+
+    def on_result(target_id, data, status):
+        nonlocal count, n_unchanged, n_checked, n_failures
+        if metrics:
+            metrics.observe_status(status)
+        if status == CrawlerDB.STATUS_RATE_LIMIT:
+            # still limited after the controller backed off: retry the ID later
+            db.update_queue_status(target_id, status)
+            print(f"[!] Rate limit encountered at ID {target_id}. Stopping crawler.")
+            return False
+        if status == CrawlerDB.STATUS_SUCCESS:
+            if data is None or not db.save_to_database(target_id, data):
+                n_unchanged += 1
+            count += 1
+            n_failures = 0
+        else:
+            n_failures += 1
+        db.update_queue_status(target_id, status)  # buffered, see CrawlerDB.flush
+        db.validators.pop(target_id, None)
+        n_checked += 1
+        # with a probed frontier the crawl ends one window past it (see
+        # scheduled_ids); without one, consecutive failures end the crawl
+        if frontier is None and max_failures > 0 and n_failures >= max_failures:
+            print(
+                f"[!] Reached maximum consecutive failures ({n_failures}). Stopping crawler."
+            )
+            return False
+        return True
+
+    # next batches come from the queue table: retries first, then new IDs
+    # (with a probed frontier, at most one window past it)
+    limit = None if frontier is None else frontier + max(1, args.frontier_window)
+
+    def scheduled_ids():
+        while ids := db.claim_ids(
+            owner,
+            lease_size,
+            args.lease_ttl,
+            backoff=args.retry_backoff,
+            max_retries=args.max_retries,
+            recheck_after=args.recheck_after,
+            recheck_window=args.recheck_window,
+            limit=limit,
+        ):
+            yield from ids
+
+    def stale_ids():
+        while ids := db.claim_stale_ids(
+            owner, lease_size, args.lease_ttl, args.refresh_age
+        ):
+            yield from ids
+
+    def fetch_with_validators(session, target_id):
+        return fetch_func(session, target_id, validators=db.validators.get(target_id))
+
+    ids = stale_ids() if refresh else scheduled_ids()
+    if step > 0:
+        ids = islice(ids, step)
+    engine = CrawlEngine(
+        fetch_with_validators if refresh else fetch_func,
+        on_result,
+        bucket=controller,
+        concurrency=concurrency,
+        timeout=timeout,
+    )
+    if metrics:
+        metrics.start_writer(args.metrics, args.metrics_interval)
     try:
-        with requests.Session() as session:
-            session.headers.update({"User-Agent": USER_AGENT})
-            while True:
-                if step > 0 and target_id >= start + step:
-                    break
-                if max_failures > 0 and n_failures >= max_failures:
-                    print(
-                        f"[!] Reached maximum consecutive failures ({n_failures}). Stopping crawler."
-                    )
-                    break
-                elapsed_time = time.time() - start_time
-                if timeout > 0 and elapsed_time >= timeout:
-                    print(
-                        f"[*] Timeout reached after {elapsed_time:.2f} seconds. Stopping crawler."
-                    )
-                    break
-                # Fetch data
-                data, status = fetch_func(session, target_id)
-                if status == CrawlerDB.STATUS_RATE_LIMIT:
-                    print(
-                        f"[!] Rate limit encountered at ID {target_id}. Stopping crawler."
-                    )
-                    break
-                if status == CrawlerDB.STATUS_SUCCESS:
-                    db.save_to_database(target_id, data)
-                    count += 1
-                    n_write += 1
-                    n_failures = 0
-                else:
-                    n_failures += 1
-                db.update_queue_status(target_id, status)
-                n_write += 1
-                if n_write % 100 == 0:  # CONFIG: Commit every 100 writes
-                    db.commit()
-                target_id += 1
-                if interval > 0:
-                    time.sleep(interval)
+        engine.run(ids)
     finally:
-        db.commit()
+        db.release_ids(owner)
+        db.close()
+        if metrics:
+            metrics.stop_writer()
 
-    print(f"[*] Total successful entries: {count} / {target_id - start}")
+    print(f"[*] Total successful entries: {count} / {n_checked}")
+    print(f"[*] Final request rate: {controller.rate:g} req/s")
+    if refresh:
+        print(f"[*] Unchanged entries: {n_unchanged} / {count}")
 
 
 if __name__ == "__main__":
     main()
 
-# __END __
+# __END__
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
+import hashlib
+import json
 import os
+import random
+import signal
+import time
 
 import mysql.connector
 
@@ -26,11 +32,46 @@ class CrawlerDB:
         "poi_type_raw",
         "last_updated_at",
     ]
+    # lock wait timeout, deadlock: retry the transaction
+    RETRY_ERRNOS = (1205, 1213)
+    CLAIM_ATTEMPTS = 5
+    # stored alongside the record for change-aware recrawls
+    VALIDATOR_FIELDNAME = ["content_hash", "http_etag", "http_last_modified"]
+    # lon/lat as a spatially indexed point (missing or out-of-range coordinates
+    # become 0, 0; ST_SRID() rejects them for SRID 4326)
+    GEOM_COLUMN = """geom POINT SRID 4326
+        GENERATED ALWAYS AS (ST_SRID(
+            IF(
+                lon > -180 AND lon <= 180 AND lat BETWEEN -90 AND 90,
+                POINT(lon, lat),
+                POINT(0, 0)
+            ),
+            4326
+        ))
+        STORED NOT NULL"""
 
-    def __init__(self, pois_table=None, queue_table=None):
+    def __init__(
+        self,
+        pois_table=None,
+        queue_table=None,
+        batch_size=500,
+        flush_interval=10,
+        metrics=None,
+    ):
         self.pois_table = pois_table
         self.queue_table = queue_table
+        self.types_table = f"{pois_table}_types"  # indexed poi_type_raw
+        self.metrics = metrics  # CrawlerMetrics, observes flush latency
         self.field_names = CrawlerDB.FIELDNAME
+        # write-behind buffer, flushed as multi-row upserts
+        self.batch_size = batch_size  # rows
+        self.flush_interval = flush_interval  # seconds
+        self.poi_rows = []
+        self.queue_rows = []
+        self.validators = {}  # raw_remote_id -> stored validators (refresh mode)
+        self.last_flush = time.monotonic()
+        self.flushing = False
+        self.pending_signal = None
         try:
             self.connection = mysql.connector.connect(
                 option_files=os.path.expanduser("~/.my.cnf"),
@@ -39,19 +80,47 @@ class CrawlerDB:
         except mysql.connector.Error as err:
             print(f"Error connecting to database: {err}")
             self.connection = None
+        # flush on normal exit and on termination signals
+        atexit.register(self.close)
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.flushing:  # let the running flush finish first
+            self.pending_signal = signum
+            return
+        raise SystemExit(128 + signum)
 
     def commit(self):
-        if self.connection:
+        if not self.connection:
+            return
+        self.flushing = True
+        try:
+            self.flush()
             self.connection.commit()
+        finally:
+            self.flushing = False
+        if signum := self.pending_signal:
+            self.pending_signal = None
+            raise SystemExit(128 + signum)
 
-    def __exit__(self):
+    def close(self):
         if self.connection:
+            self.commit()
             self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def truncate_tables(self):
         conn = self.connection
         with conn.cursor(dictionary=True) as cur:
             cur.execute(f"TRUNCATE TABLE {self.pois_table}")
+            cur.execute(f"TRUNCATE TABLE {self.types_table}")
             cur.execute(f"TRUNCATE TABLE {self.queue_table}")
 
     def create_tables_if_not_exist(self):
@@ -68,7 +137,25 @@ class CrawlerDB:
                     elevation_m DOUBLE,
                     poi_type_raw VARCHAR(255),
                     last_updated_at DATETIME,
-                    PRIMARY KEY (raw_remote_id)
+                    content_hash CHAR(40) COLLATE ascii_bin,  -- 正規化したレコードのSHA-1
+                    http_etag VARCHAR(255),
+                    http_last_modified VARCHAR(64),
+                    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                        ON UPDATE CURRENT_TIMESTAMP,  -- 差分エクスポート用の最終変更日時
+                    {self.GEOM_COLUMN},  -- 地図表示用 (poi_server.py)
+                    PRIMARY KEY (raw_remote_id),
+                    INDEX idx_updated_at (updated_at),
+                    SPATIAL INDEX idx_geom (geom)
+                )
+                """,
+            )
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.types_table} (
+                    raw_remote_id BIGINT,
+                    type_id INT,  -- poi_type_raw の各要素
+                    PRIMARY KEY (raw_remote_id, type_id),
+                    INDEX idx_type (type_id, raw_remote_id)
                 )
                 """,
             )
@@ -78,10 +165,120 @@ class CrawlerDB:
                     raw_remote_id BIGINT,
                     status TINYINT DEFAULT 0,  -- 0:未調査, 1:成功, 2:欠番(404), 3:無効(200), 4:解析失敗, -1:通信エラー
                     last_checked DATETIME,
-                    PRIMARY KEY (raw_remote_id)
+                    retries SMALLINT NOT NULL DEFAULT 0,  -- 連続した通信エラー・レート制限の回数
+                    lease_owner VARCHAR(64),  -- 貸出中のワーカー
+                    lease_expires DATETIME,  -- 貸出期限
+                    PRIMARY KEY (raw_remote_id),
+                    INDEX idx_status_lease (status, lease_expires),
+                    INDEX idx_status_checked (status, last_checked)
+                )
+                """,
+            )
+            # tables created before leasing/retries were introduced
+            if not self._has_column(cur, self.queue_table, "lease_owner"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.queue_table}
+                        ADD COLUMN lease_owner VARCHAR(64),
+                        ADD COLUMN lease_expires DATETIME,
+                        ADD INDEX idx_status_lease (status, lease_expires)
+                    """,
+                )
+            if not self._has_column(cur, self.queue_table, "retries"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.queue_table}
+                        ADD COLUMN retries SMALLINT NOT NULL DEFAULT 0 AFTER last_checked
+                    """,
+                )
+            if not self._has_index(cur, self.queue_table, "idx_status_checked"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.queue_table}
+                        ADD INDEX idx_status_checked (status, last_checked)
+                    """,
+                )
+            if not self._has_column(cur, self.pois_table, "content_hash"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.pois_table}
+                        ADD COLUMN content_hash CHAR(40) COLLATE ascii_bin,
+                        ADD COLUMN http_etag VARCHAR(255),
+                        ADD COLUMN http_last_modified VARCHAR(64)
+                    """,
+                )
+            if not self._has_column(cur, self.pois_table, "updated_at"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.pois_table}
+                        ADD COLUMN updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                            ON UPDATE CURRENT_TIMESTAMP,
+                        ADD INDEX idx_updated_at (updated_at)
+                    """,
                 )
+            if not self._has_column(cur, self.pois_table, "geom"):
+                cur.execute(
+                    f"""
+                    ALTER TABLE {self.pois_table}
+                        ADD COLUMN {self.GEOM_COLUMN},
+                        ADD SPATIAL INDEX idx_geom (geom)
+                    """,
+                )
+            elif not self._geom_checks_range(cur, self.pois_table):
+                # geom columns created before out-of-range coordinates were mapped
+                cur.execute(
+                    f"ALTER TABLE {self.pois_table} MODIFY COLUMN {self.GEOM_COLUMN}"
+                )
+
+    @staticmethod
+    def _has_column(cur, table, column):
+        cur.execute(
+            """
+            SELECT COUNT(*) AS n
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+            """,
+            (table, column),
+        )
+        return cur.fetchone()["n"] > 0
+
+    @staticmethod
+    def _geom_checks_range(cur, table):
+        cur.execute(
+            """
+            SELECT GENERATION_EXPRESSION AS expr
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'geom'
+            """,
+            (table,),
+        )
+        row = cur.fetchone()
+        return row is not None and "between" in row["expr"].lower()
+
+    @staticmethod
+    def _has_index(cur, table, index):
+        cur.execute(
+            """
+            SELECT COUNT(*) AS n
+            FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+            """,
+            (table, index),
+        )
+        return cur.fetchone()["n"] > 0
+
+    def types_missing(self):
+        # True while the types table is empty but POIs are stored, i.e. the
+        # POIs were crawled before the types table existed (see backfill_types)
+        with self.connection.cursor(dictionary=True) as cur:
+            cur.execute(
+                f"""
+                SELECT EXISTS (SELECT 1 FROM {self.pois_table}) AS has_pois,
+                    EXISTS (SELECT 1 FROM {self.types_table}) AS has_types
                 """,
             )
+            row = cur.fetchone()
+        return bool(row["has_pois"]) and not row["has_types"]
 
     def get_max_id(self):
         conn = self.connection
@@ -97,35 +294,356 @@ class CrawlerDB:
             max_id = cur.fetchone()["max_id"]
         return max_id
 
-    def save_to_database(self, target_id, data):
-        fields_str = ", ".join(self.field_names)
-        placeholders = ", ".join(["%s"] * len(self.field_names))
-        update_str = ", ".join(
-            [f"{f}=VALUES({f})" for f in self.field_names if f != "raw_remote_id"]
-        )
+    def claim_ids(
+        self,
+        owner,
+        size,
+        ttl,
+        backoff=60,
+        max_retries=8,
+        recheck_after=3600,
+        recheck_window=100,
+        limit=None,
+    ):
+        # Lease a block of IDs to `owner` for `ttl` seconds.
+        # IDs that can still succeed come first:
+        #   - queued IDs whose lease has expired or was released
+        #   - network errors / rate limits, after `backoff << retries` seconds
+        #   - the first `recheck_window` missing IDs after the last success
+        #     (they may have been allocated since), once per `recheck_after`
+        #     seconds
+        # Missing IDs below the last success are never revisited.
+        # Otherwise a new block is allocated past the highest known ID, up to
+        # `limit` if given (IDs up to the probed frontier are already queued,
+        # see enqueue_ids, so the limit keeps the crawl from running on past it).
+        # Concurrent allocations can deadlock on the gap lock after the
+        # highest ID; the losing transaction is rolled back and retried.
+        conn = self.connection
+        self.commit()
+        for attempt in range(self.CLAIM_ATTEMPTS):
+            try:
+                return self._claim_ids(
+                    owner,
+                    size,
+                    ttl,
+                    backoff,
+                    max_retries,
+                    recheck_after,
+                    recheck_window,
+                    limit,
+                )
+            except mysql.connector.Error as err:
+                conn.rollback()
+                if (
+                    err.errno not in self.RETRY_ERRNOS
+                    or attempt == self.CLAIM_ATTEMPTS - 1
+                ):
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2**attempt))
 
+    def _claim_ids(
+        self,
+        owner,
+        size,
+        ttl,
+        backoff,
+        max_retries,
+        recheck_after,
+        recheck_window,
+        limit,
+    ):
         conn = self.connection
+        max_id = self.get_max_id()
         with conn.cursor(dictionary=True) as cur:
             cur.execute(
                 f"""
-                INSERT INTO {self.pois_table} ({fields_str})
-                VALUES ({placeholders})
-                ON DUPLICATE KEY UPDATE {update_str}
+                SELECT raw_remote_id
+                FROM {self.queue_table}
+                WHERE (lease_expires IS NULL OR lease_expires < NOW()) AND (
+                    status = {self.STATUS_QUEUED}
+                    OR (
+                        status IN ({self.STATUS_NETWORK_ERROR}, {self.STATUS_RATE_LIMIT})
+                        AND retries < %s
+                        AND last_checked < NOW() - INTERVAL (%s << retries) SECOND
+                    )
+                    OR (
+                        status IN ({self.STATUS_NOT_FOUND}, {self.STATUS_INVALID})
+                        AND raw_remote_id BETWEEN %s + 1 AND %s + %s
+                        AND last_checked < NOW() - INTERVAL %s SECOND
+                    )
+                )
+                ORDER BY raw_remote_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
                 """,
-                tuple(data[i] for i in self.field_names),
+                (
+                    max_retries,
+                    backoff,
+                    max_id,
+                    max_id,
+                    recheck_window,
+                    recheck_after,
+                    size,
+                ),
             )
+            ids = [row["raw_remote_id"] for row in cur.fetchall()]
+            if ids:
+                self._lease(cur, ids, owner, ttl)
+            else:
+                # the locking read serializes block allocation between workers
+                cur.execute(
+                    f"""
+                    SELECT raw_remote_id
+                    FROM {self.queue_table}
+                    ORDER BY raw_remote_id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                    """,
+                )
+                row = cur.fetchone()
+                start = (row["raw_remote_id"] if row else 0) + 1
+                stop = start + size if limit is None else min(start + size, limit + 1)
+                ids = list(range(start, stop))
+                if ids:
+                    values_str = ", ".join(
+                        [f"(%s, {self.STATUS_QUEUED}, %s, NOW() + INTERVAL %s SECOND)"]
+                        * len(ids)
+                    )
+                    cur.execute(
+                        f"""
+                        INSERT INTO {self.queue_table}
+                            (raw_remote_id, status, lease_owner, lease_expires)
+                        VALUES {values_str}
+                        """,
+                        tuple(v for i in ids for v in (i, owner, ttl)),
+                    )
+        conn.commit()
+        return ids
 
-    def update_queue_status(self, target_id, status):
+    def enqueue_ids(self, start, frontier, chunk_size=1000):
+        # Queue every ID from `start` up to `frontier` (the estimated highest
+        # live ID), so all crawler processes work up to it without probing
+        # again. IDs already in the queue (e.g. recorded probes) are kept.
         conn = self.connection
+        self.commit()
+        n_queued = 0
+        with conn.cursor(dictionary=True) as cur:
+            for i in range(start, frontier + 1, chunk_size):
+                ids = range(i, min(i + chunk_size, frontier + 1))
+                values_str = ", ".join([f"(%s, {self.STATUS_QUEUED})"] * len(ids))
+                cur.execute(
+                    f"""
+                    INSERT IGNORE INTO {self.queue_table} (raw_remote_id, status)
+                    VALUES {values_str}
+                    """,
+                    tuple(ids),
+                )
+                n_queued += cur.rowcount
+        conn.commit()
+        return n_queued
+
+    def claim_stale_ids(self, owner, size, ttl, min_age):
+        # Lease successfully crawled IDs not checked for `min_age` seconds,
+        # stalest first, and remember their validators for the refresh.
+        conn = self.connection
+        self.commit()
         with conn.cursor(dictionary=True) as cur:
             cur.execute(
                 f"""
-                INSERT INTO {self.queue_table}
-                VALUES (%s, %s, NOW())
-                ON DUPLICATE KEY UPDATE status=VALUES(status), last_checked=VALUES(last_checked)
+                SELECT q.raw_remote_id, p.content_hash, p.http_etag, p.http_last_modified
+                FROM {self.queue_table} AS q
+                LEFT JOIN {self.pois_table} AS p USING (raw_remote_id)
+                WHERE q.status = {self.STATUS_SUCCESS}
+                    AND q.last_checked < NOW() - INTERVAL %s SECOND
+                    AND (q.lease_expires IS NULL OR q.lease_expires < NOW())
+                ORDER BY q.last_checked
+                LIMIT %s
+                FOR UPDATE OF q SKIP LOCKED
                 """,
-                (target_id, status),
+                (min_age, size),
             )
+            rows = cur.fetchall()
+            ids = [row["raw_remote_id"] for row in rows]
+            if ids:
+                self._lease(cur, ids, owner, ttl)
+        conn.commit()
+        for row in rows:
+            self.validators[row["raw_remote_id"]] = {
+                f: row[f] for f in self.VALIDATOR_FIELDNAME
+            }
+        return ids
+
+    def _lease(self, cur, ids, owner, ttl):
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur.execute(
+            f"""
+            UPDATE {self.queue_table}
+            SET lease_owner = %s, lease_expires = NOW() + INTERVAL %s SECOND
+            WHERE raw_remote_id IN ({placeholders})
+            """,
+            (owner, ttl, *ids),
+        )
+
+    def release_ids(self, owner):
+        # Give back IDs leased to `owner` that were not crawled
+        conn = self.connection
+        self.commit()
+        with conn.cursor(dictionary=True) as cur:
+            cur.execute(
+                f"""
+                UPDATE {self.queue_table}
+                SET lease_owner = NULL, lease_expires = NULL
+                WHERE lease_owner = %s
+                """,
+                (owner,),
+            )
+        conn.commit()
+
+    @classmethod
+    def content_hash(cls, data):
+        record = [data[i] for i in cls.FIELDNAME]
+        text = json.dumps(record, ensure_ascii=False, default=str)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def poi_types(poi_type_raw):
+        # yamap: a single type ID, yamareco: a JSON array of type IDs
+        value = poi_type_raw
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return []
+        values = value if isinstance(value, list) else [value]
+        return sorted({int(v) for v in values if str(v).isdigit()})
+
+    def _write_types(self, cur, rows):
+        # Replace the type rows of (raw_remote_id, poi_type_raw) pairs
+        placeholders = ", ".join(["%s"] * len(rows))
+        cur.execute(
+            f"DELETE FROM {self.types_table} WHERE raw_remote_id IN ({placeholders})",
+            tuple(target_id for target_id, _ in rows),
+        )
+        type_rows = [
+            (target_id, type_id)
+            for target_id, poi_type_raw in rows
+            for type_id in self.poi_types(poi_type_raw)
+        ]
+        if type_rows:
+            values_str = ", ".join(["(%s, %s)"] * len(type_rows))
+            cur.execute(
+                f"""
+                INSERT INTO {self.types_table} (raw_remote_id, type_id)
+                VALUES {values_str}
+                """,
+                tuple(v for row in type_rows for v in row),
+            )
+
+    def backfill_types(self, batch_size=5000):
+        # Fill the types table from poi_type_raw of every stored POI
+        conn = self.connection
+        self.commit()
+        last_id = 0
+        count = 0
+        with conn.cursor(dictionary=True) as cur:
+            while True:
+                cur.execute(
+                    f"""
+                    SELECT raw_remote_id, poi_type_raw
+                    FROM {self.pois_table}
+                    WHERE raw_remote_id > %s
+                    ORDER BY raw_remote_id
+                    LIMIT %s
+                    """,
+                    (last_id, batch_size),
+                )
+                rows = [(r["raw_remote_id"], r["poi_type_raw"]) for r in cur.fetchall()]
+                if not rows:
+                    break
+                self._write_types(cur, rows)
+                conn.commit()
+                last_id = rows[-1][0]
+                count += len(rows)
+                print(f"[*] {count} POIs backfilled (last ID {last_id})")
+        return count
+
+    def save_to_database(self, target_id, data):
+        # Returns False when the record is unchanged since the last crawl
+        content_hash = self.content_hash(data)
+        known = self.validators.pop(target_id, None)
+        if known and known["content_hash"] == content_hash:
+            return False
+        self.poi_rows.append(
+            tuple(data[i] for i in self.field_names)
+            + (content_hash, data.get("http_etag"), data.get("http_last_modified"))
+        )
+        self._flush_if_due()
+        return True
+
+    def update_queue_status(self, target_id, status):
+        retries = 1 if status < 0 else 0  # errors are retried with backoff
+        self.queue_rows.append((target_id, status, retries))
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        n_rows = len(self.poi_rows) + len(self.queue_rows)
+        if (
+            n_rows >= self.batch_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.commit()
+
+    def flush(self):
+        conn = self.connection
+        if not conn:
+            return
+        start = time.monotonic()
+        n_rows = len(self.poi_rows) + len(self.queue_rows)
+        with conn.cursor(dictionary=True) as cur:
+            if self.poi_rows:
+                field_names = self.field_names + self.VALIDATOR_FIELDNAME
+                fields_str = ", ".join(field_names)
+                placeholders = ", ".join(["%s"] * len(field_names))
+                values_str = ", ".join([f"({placeholders})"] * len(self.poi_rows))
+                # HTTP validators are kept when a record comes without them (reparse)
+                update_str = ", ".join(
+                    [
+                        (
+                            f"{f}=COALESCE(VALUES({f}), {f})"
+                            if f.startswith("http_")
+                            else f"{f}=VALUES({f})"
+                        )
+                        for f in field_names
+                        if f != "raw_remote_id"
+                    ]
+                )
+                cur.execute(
+                    f"""
+                    INSERT INTO {self.pois_table} ({fields_str})
+                    VALUES {values_str}
+                    ON DUPLICATE KEY UPDATE {update_str}
+                    """,
+                    tuple(v for row in self.poi_rows for v in row),
+                )
+                i = self.field_names.index("poi_type_raw")
+                self._write_types(cur, [(row[0], row[i]) for row in self.poi_rows])
+                self.poi_rows = []
+            if self.queue_rows:
+                values_str = ", ".join(["(%s, %s, NOW(), %s)"] * len(self.queue_rows))
+                cur.execute(
+                    f"""
+                    INSERT INTO {self.queue_table} (raw_remote_id, status, last_checked, retries)
+                    VALUES {values_str}
+                    ON DUPLICATE KEY UPDATE status=VALUES(status), last_checked=VALUES(last_checked),
+                        retries=IF(VALUES(retries) > 0, retries + 1, 0),
+                        lease_owner=NULL, lease_expires=NULL
+                    """,
+                    tuple(v for row in self.queue_rows for v in row),
+                )
+                self.queue_rows = []
+        self.last_flush = time.monotonic()
+        if self.metrics and n_rows:
+            self.metrics.observe_flush(self.last_flush - start, n_rows)
 
 
 # __END__
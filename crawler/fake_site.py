@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for yamap.com and api.yamareco.com, serving synthetic
+# landmark pages and searchPoi responses for offline crawler benchmarks:
+#   ./fake_site.py --port 8080 --latency 0.1 --gap-rate 0.2 --limit 30
+#   ./crawler.py yamap --base-url http://127.0.0.1:8080 --table-suffix _bench ...
+
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+UPDATED_AT = 1700000000  # fixed timestamp, so pages are stable across runs
+
+
+class FakeSite:
+    # Behaviour shared by all handler threads. Per-ID properties (missing or
+    # not, coordinates) derive from the seed, so every run sees the same site.
+    def __init__(
+        self,
+        latency=0.05,
+        jitter=0.0,
+        max_id=100000,
+        gap_rate=0.0,
+        error_every=0,
+        error_burst=0,
+        limit=0,
+        page_bytes=120000,
+        seed=0,
+    ):
+        self.latency = latency  # seconds per response
+        self.jitter = jitter  # +- seconds
+        self.max_id = max_id  # IDs above this do not exist (crawl frontier)
+        self.gap_rate = gap_rate  # fraction of missing IDs below max_id
+        self.error_every = error_every  # after this many requests ...
+        self.error_burst = error_burst  # ... answer this many with 503
+        self.limit = limit  # requests/sec before 429 (0: unlimited)
+        self.page_bytes = page_bytes  # approximate yamap page size
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.window_start = 0  # current 1-second rate limit window
+        self.window_count = 0
+
+    def exists(self, target_id):
+        if not 0 < target_id <= self.max_id:
+            return False
+        return random.Random(f"{self.seed}:{target_id}").random() >= self.gap_rate
+
+    def landmark(self, target_id):
+        rnd = random.Random(f"{self.seed}:{target_id}:poi")
+        return {
+            "id": target_id,
+            "name": f"山{target_id}",
+            "nameHira": f"やま{target_id}",
+            "nameEn": f"Mt. {target_id}",
+            "coord": [round(rnd.uniform(129, 145), 6), round(rnd.uniform(31, 45), 6)],
+            "altitude": rnd.randint(0, 3776),
+            "landmarkTypeId": rnd.choice([1, 2, 4, 19]),
+            "updatedAt": UPDATED_AT,
+        }
+
+    def admit(self):
+        # None, or the (status, Retry-After) of a refused request
+        with self.lock:
+            self.n_requests += 1
+            n = self.n_requests
+            now = int(time.time())
+            if now != self.window_start:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            over_limit = self.limit > 0 and self.window_count > self.limit
+        if over_limit:
+            return 429, "1"
+        if self.error_every > 0 and n % (self.error_every + self.error_burst) >= (
+            self.error_every
+        ):
+            return 503, None
+        return None
+
+    def delay(self):
+        time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def yamap_page(self, target_id):
+        next_data = {"props": {"pageProps": {"restLandmark": self.landmark(target_id)}}}
+        head = '<html><head><meta charset="utf-8"></head><body>'
+        script = (
+            '<script id="__NEXT_DATA__" type="application/json">'
+            + json.dumps(next_data, ensure_ascii=False)
+            + "</script>"
+        )
+        # real pages put the payload near the end of a long document
+        padding = max(0, self.page_bytes - len(head) - len(script))
+        body = head + "<div>" + "x" * (padding * 3 // 4) + "</div>" + script
+        body += '<script src="/_next/app.js"></script>' + "y" * (padding // 4)
+        return (body + "</body></html>").encode("utf-8")
+
+    def yamareco_json(self, target_id):
+        poilist = []
+        if self.exists(target_id):
+            landmark = self.landmark(target_id)
+            poilist.append(
+                {
+                    "name": landmark["name"],
+                    "yomi": landmark["nameHira"],
+                    "name_en": landmark["nameEn"],
+                    "lon": landmark["coord"][0],
+                    "lat": landmark["coord"][1],
+                    "elevation": landmark["altitude"],
+                    "types": [{"type_id": str(landmark["landmarkTypeId"])}],
+                }
+            )
+        return json.dumps({"err": 0, "poilist": poilist}).encode("utf-8")
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real sites
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def refuse(self):
+        site = self.server.site
+        refused = site.admit()
+        site.delay()
+        if refused:
+            status, retry_after = refused
+            self.send_body(
+                status, headers={"Retry-After": retry_after} if retry_after else None
+            )
+        return refused
+
+    def do_GET(self):
+        # GET /landmarks/<id>
+        parts = self.path.split("/")
+        if len(parts) != 3 or parts[1] != "landmarks" or not parts[2].isdigit():
+            self.send_body(404)
+            return
+        if self.refuse():
+            return
+        site = self.server.site
+        target_id = int(parts[2])
+        if not site.exists(target_id):
+            self.send_body(404)
+            return
+        body = site.yamap_page(target_id)
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        headers = {
+            "Content-Type": "text/html; charset=utf-8",
+            "ETag": etag,
+            "Last-Modified": formatdate(UPDATED_AT, usegmt=True),
+        }
+        if self.headers.get("If-None-Match") == etag:
+            self.send_body(304, headers=headers)
+            return
+        self.send_body(200, body, headers)
+
+    def do_POST(self):
+        # POST /api/v1/searchPoi (page, type_id, ptid)
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if self.path != "/api/v1/searchPoi" or not form.get("ptid", [""])[0].isdigit():
+            self.send_body(404)
+            return
+        if self.refuse():
+            return
+        body = self.server.site.yamareco_json(int(form["ptid"][0]))
+        self.send_body(200, body, {"Content-Type": "application/json"})
+
+
+class FakeSiteServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the crawler drops yamap connections right after __NEXT_DATA__
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(site, host="127.0.0.1", port=0):
+    # Start the server in a daemon thread; returns it (see server_address)
+    server = FakeSiteServer((host, port), FakeSiteHandler)
+    server.site = site
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_site_arguments(parser):
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Response latency (seconds)"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random +- latency (seconds)"
+    )
+    parser.add_argument(
+        "--max-id", type=int, default=100000, help="Highest existing ID"
+    )
+    parser.add_argument(
+        "--gap-rate", type=float, default=0.0, help="Fraction of missing IDs (404)"
+    )
+    parser.add_argument(
+        "--error-every",
+        type=int,
+        default=0,
+        help="Send a 503 burst after every N requests (0: never)",
+    )
+    parser.add_argument(
+        "--error-burst", type=int, default=3, help="Length of each 503 burst"
+    )
+    parser.add_argument(
+        "--limit",
+        type=float,
+        default=0,
+        help="Requests per second before answering 429 (0: unlimited)",
+    )
+    parser.add_argument(
+        "--page-bytes", type=int, default=120000, help="Size of a landmark page"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for missing IDs")
+
+
+def site_from_args(args):
+    return FakeSite(
+        latency=args.latency,
+        jitter=args.jitter,
+        max_id=args.max_id,
+        gap_rate=args.gap_rate,
+        error_every=args.error_every,
+        error_burst=args.error_burst if args.error_every > 0 else 0,
+        limit=args.limit,
+        page_bytes=args.page_bytes,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address")
+    parser.add_argument("--port", type=int, default=8080, help="Listen port")
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(site_from_args(args), args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"[*] Fake site listening on http://{host}:{port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
@@ -1,48 +1,227 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys
+import threading
 import time
 from argparse import ArgumentParser
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
-import bs4
 import requests
 
 USER_AGENT = "Mozilla/5.0 (Windows NT 11.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 
 
-def get_with_retry(session, url):
-    wait_time = 1
-    for i in range(5):
-        try:
-            res = session.get(url, timeout=10)
-            if res.status_code == 200:
-                return res, 0
-            if res.status_code not in [500, 502, 503, 504]:
-                break
-            time.sleep(wait_time << i)
-        except requests.RequestException as e:
-            print(f"Request error: {e}")
-            sys.exit(1)
-    return None, -1
+class TokenBucket:
+    # Thread-safe token bucket shared by all workers of a site.
+    # reserve() takes a token and returns how long the caller must wait before
+    # sending, so it works for both blocking and asyncio callers.
+    def __init__(self, rate, burst=1):
+        self.rate = rate  # requests/sec (0: unlimited)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.not_before = 0.0  # no request may start before this (Retry-After)
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.not_before)
+            if self.rate <= 0:
+                return start - now
+            self.tokens = min(
+                self.burst, self.tokens + (start - self.updated) * self.rate
+            )
+            self.updated = start
+            self.tokens -= 1
+            return start - now + max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateController(TokenBucket):
+    # AIMD rate control on top of the token bucket:
+    # - after `window` healthy responses in a row (2xx-4xx other than 429,
+    #   latency within `latency_factor` x the best seen), rate += increase
+    # - on 429/401/403/5xx, rate *= decrease (at most once per `cooldown` seconds, as
+    #   responses already in flight report the same overload), and
+    #   Retry-After holds back every worker
+    # - on a timeout or connection error, rate *= decrease likewise
+    def __init__(
+        self,
+        rate,
+        min_rate=0.2,
+        max_rate=50.0,
+        increase=0.5,
+        decrease=0.5,
+        window=20,
+        latency_factor=3.0,
+        cooldown=1.0,
+    ):
+        super().__init__(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.last_decrease = 0.0
+        self.n_healthy = 0
+        self.latency = None  # EWMA of response latency (seconds)
+        self.best_latency = None
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= self.cooldown:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.last_decrease = now
+        self.n_healthy = 0
+        return now
+
+    def on_error(self):
+        with self.lock:
+            self._decrease()
+
+    def on_response(self, status_code, latency, retry_after=None):
+        with self.lock:
+            if status_code in (429, *BLOCKED_STATUS) or status_code >= 500:
+                now = self._decrease()
+                if delay := parse_retry_after(retry_after):
+                    self.not_before = max(self.not_before, now + delay)
+                return
+            self.latency = (
+                latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            )
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            if self.latency > self.best_latency * self.latency_factor:
+                self.n_healthy = 0
+                return
+            self.n_healthy += 1
+            if self.n_healthy >= self.window:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.n_healthy = 0
+
 
+def parse_retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP-date
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
 
-def post_with_retry(session, url, payload):
-    wait_time = 2
-    for i in range(8):
+
+NEXT_DATA_START = b'<script id="__NEXT_DATA__" type="application/json">'
+NEXT_DATA_END = b"</script>"
+CHUNK_SIZE = 16 * 1024
+
+
+def extract_next_data(chunks):
+    # Scan a Next.js page, given as an iterable of byte chunks, for the
+    # __NEXT_DATA__ JSON payload and stop reading right after its </script>.
+    # Returns (payload bytes or None, number of bytes read).
+    n_read = 0
+    buf = bytearray()
+    found = False
+    for chunk in chunks:
+        n_read += len(chunk)
+        pos = max(0, len(buf) - len(NEXT_DATA_END) + 1)
+        buf += chunk
+        if not found:
+            i = buf.find(NEXT_DATA_START)
+            if i < 0:
+                del buf[: -len(NEXT_DATA_START) + 1]  # keep a possible partial tag
+                continue
+            del buf[: i + len(NEXT_DATA_START)]
+            found = True
+            pos = 0
+        j = buf.find(NEXT_DATA_END, pos)
+        if j >= 0:
+            return bytes(buf[:j]), n_read
+    return None, n_read
+
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+NOT_FOUND_STATUS = [404, 410]
+# sites answer 401/403 to a client they throttle or block, so these are
+# handled as rate limits (retried later) rather than as invalid IDs
+BLOCKED_STATUS = [401, 403]
+
+
+def request_with_retry(send, tries, wait_time, controller=None, metrics=None):
+    # code: 0=success, 1=not modified, 2=not found, 3=other client error,
+    #       -1=network error, -2=rate limit (or blocked, see BLOCKED_STATUS)
+    # With a controller, retries wait for the (reduced) shared rate and any
+    # Retry-After instead of sleeping a fixed exponential backoff.
+    status_code = None
+    for i in range(tries):
+        if i > 0:
+            if controller:
+                controller.acquire()
+            else:
+                time.sleep(wait_time << (i - 1))
         try:
-            res = session.post(url, data=payload, timeout=10)
-            if res.status_code == 200:
+            start = time.monotonic()
+            res = send()
+            status_code = res.status_code
+            latency = time.monotonic() - start
+            if controller:
+                controller.on_response(
+                    status_code, latency, res.headers.get("Retry-After")
+                )
+            if metrics:
+                metrics.observe_request(status_code, latency)
+            if status_code == 200:
                 return res, 0
-            if res.status_code == 429:
+            if status_code == 304:
+                return res, 1
+            res.close()  # release a streamed connection
+            if status_code in NOT_FOUND_STATUS:
+                return None, 2
+            if status_code in BLOCKED_STATUS:
                 return None, -2
-            if res.status_code not in [500, 502, 503, 504]:
+            if status_code not in RETRY_STATUS:
+                if status_code < 500:
+                    return None, 3  # retrying will not help
                 break
-            time.sleep(wait_time << i)
         except requests.RequestException as e:
+            # a timeout or dropped connection: back off and retry, and leave
+            # the ID to the queue if it keeps failing
             print(f"Request error: {e}")
-            sys.exit(1)
-    return None, -1
+            status_code = None
+            if controller:
+                controller.on_error()
+    return None, -2 if status_code == 429 else -1
+
+
+def get_with_retry(
+    session, url, headers=None, controller=None, stream=False, metrics=None
+):
+    return request_with_retry(
+        lambda: session.get(url, headers=headers, timeout=10, stream=stream),
+        5,
+        1,
+        controller,
+        metrics,
+    )
+
+
+def post_with_retry(session, url, payload, controller=None, metrics=None):
+    return request_with_retry(
+        lambda: session.post(url, data=payload, timeout=10), 8, 2, controller, metrics
+    )
 
 
 if __name__ == "__main__":
@@ -69,12 +248,12 @@ if __name__ == "__main__":
                 print("Failed with code:", code)
         elif site_name == "yamap":
             url = f"https://yamap.com/landmarks/{target_id}"
-            res, code = get_with_retry(session, url)
+            res, code = get_with_retry(session, url, stream=True)
             if res:
-                soup = bs4.BeautifulSoup(res.text, "html.parser")
-                script = soup.find("script", id="__NEXT_DATA__")
-                assert script and script.string
-                print(script.string)
+                with res:
+                    payload, _ = extract_next_data(res.iter_content(CHUNK_SIZE))
+                assert payload
+                print(payload.decode("utf-8"))
             else:
                 print("Failed with code:", code)
         else:
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from crawler_utils import CrawlerDB
+
+STATUS_NAMES = {
+    value: name[len("STATUS_") :].lower()
+    for name, value in vars(CrawlerDB).items()
+    if name.startswith("STATUS_")
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets  # upper bounds (seconds)
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        n = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            n += count
+            if n >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        cumulative = []
+        n = 0
+        for count in self.counts:
+            n += count
+            cumulative.append(n)
+        return {
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], cumulative)),
+            "sum": self.sum,
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class CrawlerMetrics:
+    # Counters shared by the crawl workers, the DB writer and the rate
+    # controller, written periodically as a Prometheus text file (*.prom)
+    # or a JSON snapshot (*.json).
+    LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    FLUSH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+    def __init__(self, site, controller=None):
+        self.site = site
+        self.controller = controller  # source of the current target rate
+        self.lock = threading.Lock()
+        self.latency = Histogram(self.LATENCY_BUCKETS)
+        self.flush_latency = Histogram(self.FLUSH_BUCKETS)
+        self.status_counts = {name: 0 for name in STATUS_NAMES.values()}
+        self.http_status_counts = {}
+        self.bytes_total = 0
+        self.rows_flushed = 0
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.last_checked = 0
+        self.writer = None
+
+    def observe_request(self, status_code, latency):
+        with self.lock:
+            self.latency.observe(latency)
+            key = str(status_code)
+            self.http_status_counts[key] = self.http_status_counts.get(key, 0) + 1
+
+    def observe_bytes(self, n_bytes):
+        with self.lock:
+            self.bytes_total += n_bytes
+
+    def observe_status(self, status):
+        with self.lock:
+            self.status_counts[STATUS_NAMES[status]] += 1
+
+    def observe_flush(self, seconds, n_rows):
+        with self.lock:
+            self.flush_latency.observe(seconds)
+            self.rows_flushed += n_rows
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            n_checked = sum(self.status_counts.values())
+            interval = now - self.last_time
+            current = (n_checked - self.last_checked) / interval if interval else 0
+            self.last_time = now
+            self.last_checked = n_checked
+            elapsed = now - self.start_time
+            return {
+                "site": self.site,
+                "timestamp": now,
+                "elapsed_seconds": elapsed,
+                "request_latency_seconds": self.latency.snapshot(),
+                "http_status": dict(self.http_status_counts),
+                "status": dict(self.status_counts),
+                "bytes_total": self.bytes_total,
+                "db_flush_seconds": self.flush_latency.snapshot(),
+                "db_rows_flushed": self.rows_flushed,
+                "target_rate": self.controller.rate if self.controller else None,
+                "ids_per_second": current,
+                "ids_per_second_total": n_checked / elapsed if elapsed else 0,
+            }
+
+    def write(self, path):
+        snapshot = self.snapshot()
+        if path.endswith(".json"):
+            text = json.dumps(snapshot, indent=2) + "\n"
+        else:
+            text = self.to_prometheus(snapshot)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)  # readers never see a partial file
+
+    def to_prometheus(self, snapshot):
+        site = f'site="{self.site}"'
+        lines = []
+
+        def histogram(name, help_text, data):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for le, count in data["buckets"].items():
+                lines.append(f'{name}_bucket{{{site},le="{le}"}} {count}')
+            lines.append(f"{name}_sum{{{site}}} {data['sum']}")
+            lines.append(f"{name}_count{{{site}}} {data['count']}")
+
+        def single(name, metric_type, help_text, value):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name}{{{site}}} {value}")
+
+        histogram(
+            "crawler_request_latency_seconds",
+            "HTTP request latency",
+            snapshot["request_latency_seconds"],
+        )
+        lines.append("# HELP crawler_http_responses_total HTTP responses by code")
+        lines.append("# TYPE crawler_http_responses_total counter")
+        for code, count in sorted(snapshot["http_status"].items()):
+            lines.append(
+                f'crawler_http_responses_total{{{site},code="{code}"}} {count}'
+            )
+        lines.append("# HELP crawler_status_total Queue status of crawled IDs")
+        lines.append("# TYPE crawler_status_total counter")
+        for status, count in snapshot["status"].items():
+            lines.append(f'crawler_status_total{{{site},status="{status}"}} {count}')
+        single("crawler_bytes_total", "counter", "Bytes read", snapshot["bytes_total"])
+        histogram(
+            "crawler_db_flush_seconds",
+            "CrawlerDB flush latency",
+            snapshot["db_flush_seconds"],
+        )
+        single(
+            "crawler_db_rows_flushed_total",
+            "counter",
+            "Rows written by CrawlerDB flushes",
+            snapshot["db_rows_flushed"],
+        )
+        if snapshot["target_rate"] is not None:
+            single(
+                "crawler_target_rate",
+                "gauge",
+                "Request rate allowed by the rate controller (req/s)",
+                snapshot["target_rate"],
+            )
+        single(
+            "crawler_ids_per_second",
+            "gauge",
+            "IDs checked per second since the previous snapshot",
+            snapshot["ids_per_second"],
+        )
+        return "\n".join(lines) + "\n"
+
+    def start_writer(self, path, interval):
+        # Rewrite `path` every `interval` seconds until stop_writer()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.write(path)
+
+        self.writer = (threading.Thread(target=run, daemon=True), stop, path)
+        self.writer[0].start()
+
+    def stop_writer(self):
+        if self.writer:
+            thread, stop, path = self.writer
+            stop.set()
+            thread.join()
+            self.write(path)
+            self.writer = None
+
+
+# __END__
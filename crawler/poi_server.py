@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Review map server (replaces pois.php): serves index.html and
+#   GET /pois?db=yamap|yamareco|unified&bbox=W,S,E,N&zoom=Z
+# as GeoJSON, selected through the spatial index of the crawler tables (geom)
+# or unified_pois (representative_geom, min_zoom_level).
+# The bbox is widened to the tile grid of the zoom level, so the per-tile
+# requests of index.html hit a small response cache and revalidate by ETag.
+# Uncached responses are streamed (chunked) while the rows are read; their
+# ETag is only known at the end, so it is sent from the cache next time.
+
+import hashlib
+import json
+import math
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import mysql.connector
+
+BASE_DIR = Path(__file__).resolve().parent
+STATIC_FILES = {
+    "/": ("index.html", "text/html; charset=utf-8"),
+    "/index.html": ("index.html", "text/html; charset=utf-8"),
+    "/902030.png": ("902030.png", "image/png"),
+}
+MAX_ZOOM = 20
+# geographic boxes wider than this are split (a -180..180 polygon is
+# degenerate in SRID 4326, and wide geodesic edges bulge toward the poles)
+MAX_BOX_SPAN = 90.0
+MIN_LON = -179.9999999  # SRID 4326 longitudes are in (-180, 180]
+FEATURES_PER_CHUNK = 100
+
+# CONFIG: GeoJSON sources (cnf: "crawler" or "main" connection)
+SOURCES = {
+    "yamap": {"cnf": "crawler", "table": "yamap_pois", "types": (19, 999)},
+    "yamareco": {"cnf": "crawler", "table": "yamareco_pois", "types": (1,)},
+    "unified": {"cnf": "main"},
+}
+
+
+def contains_any(n_boxes, column):
+    # column lies in one of n_boxes box WKTs
+    box = f"MBRContains(ST_GeomFromText(%s, 4326, 'axis-order=long-lat'), {column})"
+    return "(" + " OR ".join([box] * n_boxes) + ")"
+
+
+def source_query(source, n_boxes=1):
+    # SQL taking (box WKT * n_boxes[, zoom], limit);
+    # rows: id, name, lat, lon, elevation_m
+    config = SOURCES[source]
+    if source == "unified":
+        return f"""
+            SELECT id, representative_name AS name, display_lat AS lat,
+                display_lon AS lon, elevation_m
+            FROM unified_pois
+            WHERE {contains_any(n_boxes, "representative_geom")}
+                AND min_zoom_level <= %s
+            ORDER BY elevation_m DESC
+            LIMIT %s
+            """
+    table = config["table"]
+    type_list = ", ".join(str(t) for t in config["types"])
+    # crawler POIs have no display zoom: the highest ones win at low zoom
+    return f"""
+        SELECT p.raw_remote_id AS id, p.name, p.lat, p.lon, p.elevation_m
+        FROM {table} AS p
+        WHERE {contains_any(n_boxes, "p.geom")}
+            AND p.raw_remote_id IN (
+                SELECT raw_remote_id FROM {table}_types WHERE type_id IN ({type_list})
+            )
+        ORDER BY p.elevation_m DESC
+        LIMIT %s
+        """
+
+
+def tile_x(lon, zoom):
+    return (lon + 180.0) / 360.0 * (1 << zoom)
+
+
+def tile_y(lat, zoom):
+    lat = max(-85.0511, min(85.0511, lat))
+    rad = math.radians(lat)
+    return (1.0 - math.asinh(math.tan(rad)) / math.pi) / 2.0 * (1 << zoom)
+
+
+def tile_lon(x, zoom):
+    return x / (1 << zoom) * 360.0 - 180.0
+
+
+def tile_lat(y, zoom):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / (1 << zoom)))))
+
+
+def snap_bbox(west, south, east, north, zoom):
+    # Widen a bbox to whole tiles of `zoom`: (x0, y0, x1, y1) tile range
+    # (a tile bbox sent by index.html maps back to its own tile)
+    n = 1 << zoom
+    eps = 1e-6
+    x0 = max(0, math.floor(tile_x(west, zoom) + eps))
+    x1 = min(n, max(x0 + 1, math.ceil(tile_x(east, zoom) - eps)))
+    y0 = max(0, math.floor(tile_y(north, zoom) + eps))
+    y1 = min(n, max(y0 + 1, math.ceil(tile_y(south, zoom) - eps)))
+    return x0, y0, x1, y1
+
+
+def tiles_wkts(x0, y0, x1, y1, zoom):
+    # Box WKTs covering a tile range, each at most MAX_BOX_SPAN degrees wide
+    west, east = tile_lon(x0, zoom), tile_lon(x1, zoom)
+    north, south = tile_lat(y0, zoom), tile_lat(y1, zoom)
+    n = math.ceil((east - west) / MAX_BOX_SPAN - 1e-9)
+    lons = [west + (east - west) * i / n for i in range(n)] + [east]
+    lons[0] = max(MIN_LON, west)
+    return [
+        f"POLYGON(({w} {south}, {e} {south}, {e} {north},"
+        f" {w} {north}, {w} {south}))"
+        for w, e in zip(lons, lons[1:])
+    ]
+
+
+class ResponseCache:
+    # LRU of (etag, body) with a time-to-live, shared by the handler threads
+    def __init__(self, max_entries=4096, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl  # seconds
+        self.entries = OrderedDict()  # key -> (expires, etag, body)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, key, etag, body):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class PoiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, option_files, cache, max_features):
+        super().__init__(address, PoiRequestHandler)
+        self.option_files = option_files  # "crawler" / "main" -> .my.cnf path
+        self.cache = cache
+        self.max_features = max_features
+        self.local = threading.local()  # one connection per thread and cnf
+        self.types_ready = set()  # crawler sources whose types table is filled
+
+    def connection(self, cnf):
+        conns = self.local.__dict__.setdefault("conns", {})
+        conn = conns.get(cnf)
+        if conn is None or not conn.is_connected():
+            conn = mysql.connector.connect(
+                option_files=self.option_files[cnf], autocommit=True
+            )
+            conns[cnf] = conn
+        return conn
+
+    def types_missing(self, source):
+        # Crawler POIs are selected through <table>_types; while it is empty
+        # (POIs crawled before it existed, not backfilled yet) every tile would
+        # come back empty, so report it instead. Checked until it is filled.
+        if source in self.types_ready or "types" not in SOURCES[source]:
+            return False
+        table = SOURCES[source]["table"]
+        with self.connection(SOURCES[source]["cnf"]).cursor() as cur:
+            cur.execute(f"""
+                SELECT EXISTS (SELECT 1 FROM {table}),
+                    EXISTS (SELECT 1 FROM {table}_types)
+                """)
+            has_pois, has_types = cur.fetchone()
+        if has_pois and not has_types:
+            return True
+        self.types_ready.add(source)
+        return False
+
+    def geojson(self, source, tiles, zoom):
+        # Encode the features of a tile range as they are read, yielding the
+        # GeoJSON in pieces. The query runs on the first next(), so database
+        # errors surface before anything is sent.
+        conn = self.connection(SOURCES[source]["cnf"])
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        done = False
+        try:
+            params = tiles_wkts(*tiles, zoom)
+            n_boxes = len(params)
+            if source == "unified":
+                params.append(zoom)  # min_zoom_level
+            params.append(self.max_features)
+            cursor.execute(source_query(source, n_boxes), tuple(params))
+            yield b'{"type":"FeatureCollection","features":['
+            parts = []
+            for i, row in enumerate(cursor):
+                feature = {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [float(row["lon"]), float(row["lat"])],
+                    },
+                    "properties": {
+                        "name": row["name"],
+                        "elevation": (
+                            float(row["elevation_m"])
+                            if row["elevation_m"] is not None
+                            else None
+                        ),
+                        "id": row["id"],
+                    },
+                }
+                if i > 0:
+                    parts.append(",")
+                parts.append(json.dumps(feature, ensure_ascii=False))
+                if len(parts) >= 2 * FEATURES_PER_CHUNK:
+                    yield "".join(parts).encode("utf-8")
+                    parts = []
+            parts.append("]}")
+            yield "".join(parts).encode("utf-8")
+            done = True
+        finally:
+            if done:
+                cursor.close()
+            else:
+                conn.close()  # rows left unread: reconnect on the next request
+
+
+class PoiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive and chunked responses
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_chunked(self, head, chunks, headers):
+        # Send `head` and each following piece as it is produced; returns the
+        # whole body, or None if producing it failed (the response is then
+        # cut off, not completed)
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        parts = []
+        try:
+            for chunk in chain([head], chunks):
+                if chunk:
+                    parts.append(chunk)
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        except mysql.connector.Error as e:
+            print(f"[!] Database error while streaming: {e}", file=sys.stderr)
+            self.close_connection = True
+            return None
+        finally:
+            chunks.close()
+        self.wfile.write(b"0\r\n\r\n")
+        return b"".join(parts)
+
+    def send_error_json(self, status, message):
+        body = json.dumps(
+            {"type": "FeatureCollection", "features": [], "error": message}
+        ).encode("utf-8")
+        self.send_body(status, body, {"Content-Type": "application/geo+json"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path in STATIC_FILES:
+            name, content_type = STATIC_FILES[url.path]
+            body = (BASE_DIR / name).read_bytes()
+            self.send_body(200, body, {"Content-Type": content_type})
+        elif url.path == "/pois":
+            self.do_pois(parse_qs(url.query))
+        else:
+            self.send_body(404)
+
+    do_HEAD = do_GET
+
+    def do_pois(self, query):
+        source = query.get("db", ["yamap"])[0]
+        try:
+            west, south, east, north = map(float, query["bbox"][0].split(","))
+            zoom = max(0, min(MAX_ZOOM, int(query.get("zoom", ["13"])[0])))
+        except (KeyError, ValueError):
+            self.send_error_json(400, "bbox=W,S,E,N and zoom=Z are required")
+            return
+        if source not in SOURCES:
+            self.send_error_json(400, f"unknown db: {source}")
+            return
+
+        server = self.server
+        try:
+            if server.types_missing(source):
+                self.send_error_json(
+                    503,
+                    f"{SOURCES[source]['table']}_types is empty:"
+                    f" run backfill_types.py {source}",
+                )
+                return
+        except mysql.connector.Error as e:
+            self.send_error_json(500, f"Database error: {e}")
+            return
+        tiles = snap_bbox(west, south, east, north, zoom)
+        key = (source, zoom, tiles)
+        headers = {
+            "Content-Type": "application/geo+json; charset=utf-8",
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "no-cache",  # revalidate with If-None-Match
+        }
+        cached = server.cache.get(key)
+        if cached:
+            etag, body = cached
+        else:
+            chunks = server.geojson(source, tiles, zoom)
+            try:
+                head = next(chunks)  # runs the query
+                if self.command == "HEAD":
+                    body = head + b"".join(chunks)
+            except mysql.connector.Error as e:
+                self.send_error_json(500, f"Database error: {e}")
+                return
+            if self.command != "HEAD":
+                body = self.send_chunked(head, chunks, headers)
+                if body is None:
+                    return
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            server.cache.put(key, etag, body)
+            if self.command != "HEAD":
+                return
+
+        headers["ETag"] = etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_body(304, headers=headers)
+        else:
+            self.send_body(200, body, headers)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address")
+    parser.add_argument("--port", type=int, default=8000, help="Listen port")
+    parser.add_argument(
+        "--crawler-cnf",
+        default=str(BASE_DIR / "crawler.my.cnf"),
+        help="Option file of the crawler database (yamap, yamareco)",
+    )
+    parser.add_argument(
+        "--cnf",
+        default=str(Path(sys.prefix).parent / ".my.cnf"),
+        help="Option file of the main database (unified)",
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=60, help="Response cache TTL (seconds)"
+    )
+    parser.add_argument("--cache-size", type=int, default=4096, help="Cached responses")
+    parser.add_argument(
+        "--max-features", type=int, default=500, help="Max features per response"
+    )
+    args = parser.parse_args()
+
+    server = PoiServer(
+        (args.host, args.port),
+        {"crawler": args.crawler_cnf, "main": args.cnf},
+        ResponseCache(args.cache_size, args.cache_ttl),
+        args.max_features,
+    )
+    print(f"[*] Serving the review map on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
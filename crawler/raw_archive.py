@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import os
+from pathlib import Path
+
+
+class RawArchive:
+    # Content-addressed store of raw crawler responses:
+    #   <root>/<site>/<id // 10000>/<id>/<sha1 of payload>.gz
+    # An unchanged payload is written once; its mtime marks the last time it
+    # was seen, so the newest file of an ID is the current version.
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _id_dir(self, site, target_id):
+        return self.root / site / str(target_id // 10000) / str(target_id)
+
+    def store(self, site, target_id, payload):
+        digest = hashlib.sha1(payload).hexdigest()
+        id_dir = self._id_dir(site, target_id)
+        path = id_dir / f"{digest}.gz"
+        if path.exists():
+            os.utime(path)
+            return digest
+        id_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = id_dir / f".{digest}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return digest
+
+    def load(self, site, target_id):
+        # Latest payload of an ID, or None
+        id_dir = self._id_dir(site, target_id)
+        if not id_dir.is_dir():
+            return None
+        return self._load_latest(id_dir)
+
+    def iter_latest(self, site):
+        # Yield (target_id, payload) for every archived ID in ID order
+        site_dir = self.root / site
+        if not site_dir.is_dir():
+            return
+        buckets = [d for d in site_dir.iterdir() if d.name.isdigit()]
+        for bucket in sorted(buckets, key=lambda d: int(d.name)):
+            id_dirs = [d for d in bucket.iterdir() if d.name.isdigit()]
+            for id_dir in sorted(id_dirs, key=lambda d: int(d.name)):
+                payload = self._load_latest(id_dir)
+                if payload is not None:
+                    yield int(id_dir.name), payload
+
+    @staticmethod
+    def _load_latest(id_dir):
+        files = list(id_dir.glob("*.gz"))
+        if not files:
+            return None
+        latest = max(files, key=lambda p: p.stat().st_mtime)
+        with gzip.open(latest, "rb") as f:
+            return f.read()
+
+
+# __END__
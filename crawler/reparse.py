@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Rebuild yamap_pois / yamareco_pois from the raw response archive
+# (crawler.py --archive DIR) without any network access.
+
+from argparse import ArgumentParser
+
+from crawler import SITES
+from crawler_utils import CrawlerDB
+from raw_archive import RawArchive
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("site_name", choices=SITES.keys(), help="Site to reparse")
+    parser.add_argument("archive", help="Raw response archive directory")
+    parser.add_argument(
+        "--truncate",
+        action="store_true",
+        help="Empty the POI table first (the queue table is kept)",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="DB rows buffered per flush"
+    )
+    args = parser.parse_args()
+    site_name = args.site_name.lower()
+    site = SITES[site_name]
+    parse_func = site["parse_func"]
+
+    with CrawlerDB(
+        pois_table=site["pois_table"],
+        queue_table=site["queue_table"],
+        batch_size=args.batch_size,
+    ) as db:
+        db.create_tables_if_not_exist()
+        if args.truncate:
+            with db.connection.cursor() as cur:
+                cur.execute(f"TRUNCATE TABLE {db.pois_table}")
+                cur.execute(f"TRUNCATE TABLE {db.types_table}")
+        count = 0  # Number of archived entries
+        n_saved = 0  # Number of entries parsed into a record
+        for target_id, payload in RawArchive(args.archive).iter_latest(site_name):
+            count += 1
+            data, status = parse_func(target_id, payload)
+            if status == CrawlerDB.STATUS_SUCCESS:
+                db.save_to_database(target_id, data)
+                n_saved += 1
+            if count % 10000 == 0:
+                print(f"[*] {count} entries reparsed")
+
+    print(f"[*] Total reparsed entries: {n_saved} / {count}")
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
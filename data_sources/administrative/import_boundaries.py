@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# 行政区域境界のGeoJSON (または N03-*_GML.zip) を1地物ずつ読み込んでDBに登録
+# ジオメトリはWKBで渡す (GeoJSON文字列に戻さない)
+# あわせて境界を格子セルごとに切り分けた小さな多角形をセルのテーブルに登録する
+# (点の包含判定で、空間索引の候補に対する厳密な判定を小さな多角形で済ませるため)
+
 import json
 import sys
 from argparse import ArgumentParser
 from pathlib import Path
 
 import mysql.connector
+from shared import (
+    box_wkb,
+    collection_wkb,
+    geometry_polygons,
+    grid_cells,
+    ImportFingerprint,
+    iter_features,
+    open_geojson,
+    polygon_wkb,
+)
 
 # コマンドライン引数の解析
 parser = ArgumentParser(description="行政区域境界のGeoJSONファイルをDBに登録")
-parser.add_argument("geojson_file", help="行政区域境界のGeoJSONファイル・パス")
+parser.add_argument(
+    "geojson_file",
+    help="行政区域境界のGeoJSONファイル、またはそれを含むZIPファイルのパス",
+)
 parser.add_argument("table_name", help="登録先のテーブル名")
 parser.add_argument(
     "-m",
@@ -22,11 +40,32 @@ parser.add_argument(
 parser.add_argument(
     "-t", "--truncate", action="store_true", help="登録前にテーブルを空にする"
 )
+parser.add_argument(
+    "-c",
+    "--cells-table",
+    default="administrative_boundary_cells",
+    help="格子分割した境界の登録先テーブル名 (デフォルト: administrative_boundary_cells)",
+)
+parser.add_argument(
+    "-s",
+    "--cell-size",
+    type=float,
+    default=0.1,
+    help="格子セルの大きさ[度] (デフォルト: 0.1)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="前回の取込と同じファイルでも取り込む",
+)
 args = parser.parse_args()
 geojson_file = args.geojson_file
 table_name = args.table_name
 max_count = args.max_count
 truncate = args.truncate
+cells_table = args.cells_table
+cell_size = args.cell_size
 
 # MySQL接続の確立
 try:
@@ -40,54 +79,140 @@ except mysql.connector.Error as e:
     print(f"MySQL Connection Error: {e}")
     sys.exit(1)
 
+# 前回と同じファイルなら取込を省略
+try:
+    fingerprint = ImportFingerprint(conn, table_name, geojson_file)
+    if not args.force and fingerprint.matches():
+        print(
+            f"{geojson_file} is unchanged since the last import into {table_name}, skipping."
+        )
+        sys.exit(0)
+except FileNotFoundError:
+    print(f"File not found: {geojson_file}")
+    sys.exit(1)
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
 # テーブルを空にする
+fingerprint.forget(replace=truncate)
 if truncate:
     try:
         cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
         cursor.execute(f"TRUNCATE TABLE {table_name}")
+        cursor.execute(f"TRUNCATE TABLE {cells_table}")
         cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
         conn.commit()
-        print(f"Table {table_name} truncated.")
+        print(f"Tables {table_name} and {cells_table} truncated.")
     except mysql.connector.Error as e:
         print(f"MySQL Error during truncation: {e}")
         sys.exit(1)
 
+# 登録済みの行政区画コード (外部キー違反になる境界は、どちらのテーブルにも登録しない)
+try:
+    cursor.execute("SELECT jis_code FROM administrative_regions")
+    jis_codes = {row["jis_code"] for row in cursor.fetchall()}
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
+# 1つの多角形を切り分けるセル数の上限は再帰CTEの深さの上限でもある
+recursion_depth = 1000  # cte_max_recursion_depth の既定値
 
-def insert_geom_data(values):
+
+def cell_values(jis_code, rings, wkb):
+    # 1つのセルに収まる多角形はそのまま、複数のセルにまたがる多角形は
+    # セルの矩形の GeometryCollection を添えてサーバ側で切り分ける
+    cells = [box_wkb(*cell) for cell in grid_cells(rings, cell_size)]
+    if len(cells) == 1:
+        return (jis_code, None, wkb, None)
+    return (jis_code, len(cells), wkb, collection_wkb(cells))
+
+
+def insert_geom_data(values, cell_data):
+    global recursion_depth
     try:
+        max_cells = max((n or 0 for _, n, _, _ in cell_data), default=0)
+        if max_cells > recursion_depth:
+            cursor.execute("SET SESSION cte_max_recursion_depth = %s", (max_cells,))
+            recursion_depth = max_cells
         cursor.executemany(
             f"""
             INSERT IGNORE INTO {table_name} (jis_code, geom) VALUES
-            (%s, ST_GeomFromGeoJSON(%s))
+            (%s, ST_GeomFromWKB(%s, 4326, "axis-order=long-lat"))
             """,
             values,
         )
+        cursor.executemany(
+            f"""
+            INSERT IGNORE INTO {cells_table} (jis_code, geom) VALUES
+            (%s, ST_GeomFromWKB(%s, 4326, "axis-order=long-lat"))
+            """,
+            [(jis_code, wkb) for jis_code, n, wkb, _ in cell_data if n is None],
+        )
+        for jis_code, n, wkb, cells in cell_data:
+            if n is None:
+                continue
+            cursor.execute(
+                f"""
+                INSERT IGNORE INTO {cells_table} (jis_code, geom)
+                WITH RECURSIVE seq (i) AS (
+                    SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < %s
+                )
+                SELECT jis_code, geom FROM (
+                    SELECT %s AS jis_code, ST_Intersection(
+                        p.geom, ST_GeometryN(c.geom, seq.i)
+                    ) AS geom
+                    FROM (
+                        SELECT ST_GeomFromWKB(%s, 4326, "axis-order=long-lat") AS geom
+                    ) AS p, (
+                        SELECT ST_GeomFromWKB(%s, 4326, "axis-order=long-lat") AS geom
+                    ) AS c, seq
+                ) AS t
+                WHERE ST_Dimension(geom) = 2
+                """,
+                (n, jis_code, wkb, cells),
+            )
         conn.commit()
+        return True
     except mysql.connector.Error as e:
         print(f"MySQL Error during insertion: {e}")
         conn.rollback()
+        return False
 
 
+n_failed = 0  # Number of failed batches
+n_skipped = 0  # Number of features without a known jis_code
 try:
-    with open(args.geojson_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    values = []
-    count = 0
-    for feature in data["features"]:
-        properties = feature["properties"]
-        jis_code = properties["N03_007"]
-        geometry_json = json.dumps(feature["geometry"])
-        values.append((jis_code, geometry_json))
-        count += 1
-        if count % max_count == 0:
-            insert_geom_data(values)
-            print(f"Inserted {count} rows into {table_name}")
-            values = []
+    with open_geojson(geojson_file) as f:
+        values = []
+        cell_data = []
+        count = 0
+        for feature in iter_features(f):
+            properties = feature["properties"]
+            jis_code = properties["N03_007"]
+            if jis_code not in jis_codes:
+                n_skipped += 1
+                continue
+            # MultiPolygon は Polygon ごとの行に分ける
+            for rings in geometry_polygons(feature["geometry"]):
+                wkb = polygon_wkb(rings)
+                values.append((jis_code, wkb))
+                cell_data.append(cell_values(jis_code, rings, wkb))
+                count += 1
+                if count % max_count == 0:
+                    n_failed += not insert_geom_data(values, cell_data)
+                    print(f"Inserted {count} rows into {table_name}")
+                    values = []
+                    cell_data = []
 
     if values:
-        insert_geom_data(values)
+        n_failed += not insert_geom_data(values, cell_data)
         print(f"Inserted {count} rows into {table_name}")
+    if n_skipped:
+        print(f"Skipped {n_skipped} features with an unknown or missing N03_007")
+    if not n_failed:
+        fingerprint.record(replace=truncate)
 
 except FileNotFoundError:
     print(f"File not found: {geojson_file}")
@@ -95,6 +220,8 @@ except json.JSONDecodeError as e:
     print(f"Error parsing JSON file: {e}")
 except KeyError as e:
     print(f"Missing expected key in GeoJSON data: {e}")
+except ValueError as e:
+    print(f"Invalid geometry in GeoJSON data: {e}")
 
 cursor.close()
 conn.close()
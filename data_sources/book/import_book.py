@@ -5,32 +5,79 @@
 
 import csv
 import json
+import multiprocessing
 import os
 import re
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import mysql.connector
 from shared import generate_source_uuid
 from shared import extract_aliases
+from shared import ImportFingerprint
 
 # コマンドライン引数の解析
 parser = ArgumentParser(description="書籍のCSVファイルをDBに登録")
-parser.add_argument("source_id", help="情報源ID")
-parser.add_argument("csv_file", help="書籍のCSVファイル・パス")
 parser.add_argument(
-    "-t", "--truncate", action="store_true", help="登録前にテーブルを空にする"
+    "paths",
+    nargs="+",
+    help="書籍のCSVファイル (<情報源ID>_*.csv)、またはそれを含むディレクトリ",
+)
+parser.add_argument(
+    "-t",
+    "--truncate",
+    action="store_true",
+    help="登録前に対象の情報源IDのデータを削除する",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=4,
+    help="並列に別名を展開するプロセス数 (デフォルト: 4)",
+)
+parser.add_argument(
+    "-m",
+    "--max-count",
+    type=int,
+    default=5000,
+    help="1回の INSERT で登録する行数 (デフォルト: 5000)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="前回の取込と同じファイルでも取り込む",
 )
 args = parser.parse_args()
-source_id = int(args.source_id)
-csv_file = args.csv_file
 truncate = args.truncate
+max_count = args.max_count
 
 table_name = "stg_book_pois"
 
-if os.path.isfile(csv_file) and os.path.getsize(csv_file) == 0:
-    print(f"空のファイルのため処理をスキップします: {csv_file}")
+# ファイル名の先頭の数字が情報源ID (ディレクトリなら [0-9]*.csv を対象とする)
+csv_files = {}
+for path in args.paths:
+    paths = sorted(Path(path).glob("[0-9]*.csv")) if os.path.isdir(path) else [path]
+    for csv_file in map(str, paths):
+        m = re.match(r"(\d+)_.*\.csv$", os.path.basename(csv_file))
+        if not m:
+            print(f"情報源IDをファイル名から取得できません: {csv_file}")
+            sys.exit(1)
+        source_id = int(m.group(1))
+        if source_id in csv_files:
+            print(f"情報源ID {source_id} のファイルが重複しています: {csv_file}")
+            sys.exit(1)
+        if not os.path.isfile(csv_file):
+            print(f"File not found: {csv_file}")
+            sys.exit(1)
+        if os.path.getsize(csv_file) == 0:
+            print(f"空のファイルのため処理をスキップします: {csv_file}")
+            continue
+        csv_files[source_id] = csv_file
+if not csv_files:
     sys.exit(0)
 
 # MySQL接続の確立
@@ -45,67 +92,126 @@ except mysql.connector.Error as e:
     print(f"MySQL Error: {e}")
     sys.exit(1)
 
-# 情報源の正式名称とNDL書誌IDを取得
+# 情報源の正式名称とNDL書誌IDをまとめて取得
+placeholders = ",".join(["%s"] * len(csv_files))
 cursor.execute(
-    "SELECT formal_title, ndl_id FROM book_details WHERE source_id = %s",
-    (source_id,),
+    f"""
+    SELECT source_id, formal_title, ndl_id FROM book_details
+    WHERE source_id IN ({placeholders})
+    """,
+    tuple(csv_files),
 )
-result = cursor.fetchone()
-if not result:
-    print(f"No book found with source_id {source_id}")
-    sys.exit(1)
-formal_title = result["formal_title"]
-ndl_id = result["ndl_id"]
-print(f"Processing book: {formal_title} (NDL{ndl_id})")
-
-# 指定された情報源IDのデータを削除
-if truncate:
-    try:
-        cursor.execute(f"DELETE FROM {table_name} WHERE source_id = %s", (source_id,))
-        conn.commit()
-        print(f"Table {table_name} truncated for source_id {source_id}.")
-    except mysql.connector.Error as e:
-        print(f"MySQL Error during truncation: {e}")
+books = {row["source_id"]: row for row in cursor.fetchall()}
+for source_id in csv_files:
+    if source_id not in books:
+        print(f"No book found with source_id {source_id}")
         sys.exit(1)
 
-# CSVファイルの読み込み
-with open(csv_file, "r", encoding="utf-8-sig") as f:
-    reader = csv.DictReader(f)
-    values = []
-    for row in reader:
-        raw_remote_id = row["raw_remote_id"]
-        uuid = generate_source_uuid(f"NDL{ndl_id}_poi", raw_remote_id)
-        aliases = extract_aliases(row["name"], row["kana"])
-        data = [{"name": name, "kana": kana} for name, kana in aliases]
-        names_json = json.dumps(data, ensure_ascii=False)
-        values.append(
-            (
-                uuid.bytes,
-                raw_remote_id,
-                names_json,
-                row["elevation_m"] or None,
-                source_id,
-                row["unified_poi_id"] or None,
+# 前回と同じファイルは取込を省略 (書籍ごとのファイルなので他の書籍の記録は残す)
+fingerprints = {}
+try:
+    for source_id, csv_file in csv_files.items():
+        fingerprint = ImportFingerprint(conn, table_name, csv_file)
+        if not args.force and fingerprint.matches():
+            print(
+                f"{csv_file} is unchanged since the last import into {table_name}, skipping."
             )
+            continue
+        fingerprints[source_id] = fingerprint
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+if not fingerprints:
+    sys.exit(0)
+
+
+def names_json_of(name, kana):
+    # 別名を展開した names_json (子プロセスで実行)
+    aliases = extract_aliases(name, kana)
+    data = [{"name": name, "kana": kana} for name, kana in aliases]
+    return json.dumps(data, ensure_ascii=False)
+
+
+def read_book(csv_file):
+    with open(csv_file, "r", encoding="utf-8-sig") as f:
+        return list(csv.DictReader(f))
+
+
+# 同じ山名は複数の書籍に現れるので、全ファイルの (山名, よみ) の組を先に集め、
+# 組ごとに1回だけ別名を展開する。展開は複数のプロセスで並列に行う
+# (スクリプトを再実行しないように fork で子プロセスを作る)
+source_ids = list(fingerprints)
+book_rows = {source_id: read_book(csv_files[source_id]) for source_id in source_ids}
+pairs = list(
+    dict.fromkeys(
+        (row["name"], row["kana"]) for rows in book_rows.values() for row in rows
+    )
+)
+with ProcessPoolExecutor(
+    max_workers=args.jobs, mp_context=multiprocessing.get_context("fork")
+) as executor:
+    names_json = dict(
+        zip(
+            pairs,
+            executor.map(
+                names_json_of,
+                [name for name, _ in pairs],
+                [kana for _, kana in pairs],
+                chunksize=max(1, len(pairs) // (4 * max(1, args.jobs))),
+            ),
         )
+    )
 
-# データの挿入
+values = {}
+for source_id in source_ids:
+    ndl_id = books[source_id]["ndl_id"]
+    values[source_id] = [
+        (
+            generate_source_uuid(f"NDL{ndl_id}_poi", row["raw_remote_id"]).bytes,
+            row["raw_remote_id"],
+            names_json[(row["name"], row["kana"])],
+            row["elevation_m"] or None,
+            source_id,
+            row["unified_poi_id"] or None,
+        )
+        for row in book_rows[source_id]
+    ]
+
+# 対象の情報源IDのデータを1トランザクションで入れ替える
 try:
-    cursor.executemany(
-        f"""
-        INSERT INTO {table_name} (
-            source_uuid, raw_remote_id, names_json, elevation_m, source_id, unified_poi_id
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s
+    if truncate:
+        cursor.executemany(
+            f"DELETE FROM {table_name} WHERE source_id = %s",
+            [(source_id,) for source_id in source_ids],
+        )
+    for source_id in source_ids:
+        book = books[source_id]
+        rows = values[source_id]
+        for i in range(0, len(rows), max_count):
+            cursor.executemany(
+                f"""
+                INSERT INTO {table_name} (
+                    source_uuid, raw_remote_id, names_json, elevation_m,
+                    source_id, unified_poi_id
+                ) VALUES (
+                    %s, %s, %s, %s, %s, %s
+                )
+                """,
+                rows[i : i + max_count],
+            )
+        print(
+            f"{book['formal_title']} (NDL{book['ndl_id']}):"
+            f" {len(rows)} rows from {csv_files[source_id]}"
         )
-        """,
-        values,
-    )
     conn.commit()
-    print(f"Inserted {cursor.rowcount} rows into {table_name}")
 except mysql.connector.Error as e:
-    print(f"MySQL Error during insertion: {e}")
+    print(f"MySQL Error during import: {e}")
     conn.rollback()
+    sys.exit(1)
+print(f"{sum(map(len, values.values()))} rows inserted into {table_name}.")
+
+for fingerprint in fingerprints.values():
+    fingerprint.record()
 
 # MySQL接続のクローズ
 cursor.close()
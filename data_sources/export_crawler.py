@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# クローラのテーブル (yamap_pois / yamareco_pois) から dist/<source>.csv を直接出力する
+# dump_db.sh + tsv2csv.py の置き換え。行はサーバ側カーソルで逐次読み込み、
+# tsv2csv.py と同じ変換を適用する。
+# --incremental では前回の出力以降に更新された行だけを変換し、既存のCSVに反映する。
+
+import csv
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import mysql.connector
+
+from tsv2csv import (
+    FIELDNAMES,
+    add_boundary_arguments,
+    boundary_index_from_args,
+    convert_row,
+)
+
+CRAWLER_CNF = Path(__file__).resolve().parent.parent / "crawler" / "crawler.my.cnf"
+
+# CONFIG: 出力対象の抽出条件 (types: <table>_types の type_id)
+# changed: --incremental で更新されたとみなす日時の列 (出力する列の元になるもの全て)
+SOURCES = {
+    "yamap": {
+        "table": "yamap_pois",
+        "columns": "p.last_updated_at",
+        "join": "",
+        "types": (19, 999),
+        "changed": ("p.updated_at",),
+    },
+    "yamareco": {
+        "table": "yamareco_pois",
+        "columns": "q.last_checked AS last_updated_at",
+        "join": "JOIN yamareco_queue AS q USING (raw_remote_id)",
+        "types": (1,),
+        "changed": ("p.updated_at", "q.last_checked"),
+    },
+}
+
+
+def iter_crawled_rows(conn, source, since=None):
+    # 未バッファのカーソルで1行ずつ読む (テーブル全体をメモリに載せない)
+    config = SOURCES[source]
+    table = config["table"]
+    type_list = ", ".join(str(t) for t in config["types"])
+    # 種別は <table>_types の索引で絞り込む (poi_type_raw は参照しない)
+    targets = f"""
+        SELECT raw_remote_id FROM {table}_types WHERE type_id IN ({type_list})
+        """
+    if since:
+        # 対象外になった行も既存のCSVから除くため、種別で絞らずに読む
+        is_target = f"p.raw_remote_id IN ({targets})"
+        where = " OR ".join(f"{column} >= %s" for column in config["changed"])
+        params = (since,) * len(config["changed"])
+    else:
+        is_target = "1"
+        where = f"p.raw_remote_id IN ({targets})"
+        params = ()
+    sql = f"""
+        SELECT p.raw_remote_id, p.name, p.kana, p.lat, p.lon, p.elevation_m,
+            p.poi_type_raw, {config["columns"]}, {is_target} AS is_target
+        FROM {table} AS p
+        {config["join"]}
+        WHERE {where}
+        """
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def has_updated_at(conn, source):
+    # updated_at はクローラが create_tables_if_not_exist() で追加する
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                AND COLUMN_NAME = 'updated_at'
+            """,
+            (SOURCES[source]["table"],),
+        )
+        return cur.fetchone()[0] > 0
+
+
+def types_missing(conn, source):
+    # <table>_types が空で POI だけある (種別の索引が未作成) なら True
+    # そのまま出力すると全行が対象外になるので、呼び出し側で中止する
+    table = SOURCES[source]["table"]
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT EXISTS (SELECT 1 FROM {table}),
+                EXISTS (SELECT 1 FROM {table}_types)
+            """)
+        has_pois, has_types = cur.fetchone()
+    return bool(has_pois) and not has_types
+
+
+def export_rows(source, rows, japan):
+    # (raw_remote_id, 変換後のCSV行のリスト) を返す。対象外の行は空リスト
+    for row in rows:
+        is_target = row.pop("is_target")
+        if not is_target:
+            yield row["raw_remote_id"], []
+            continue
+        yield row["raw_remote_id"], convert_row(source, row, japan)
+
+
+def load_state(state_file):
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = ArgumentParser(description="クローラのテーブルからCSVを出力")
+    parser.add_argument(
+        "source",
+        choices=SOURCES.keys(),
+        help="データソース（yamap または yamareco）を指定",
+    )
+    parser.add_argument("csv_file", help="出力するCSVファイルのパス")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="前回の出力以降に更新された行だけを既存のCSVに反映",
+    )
+    parser.add_argument(
+        "--crawler-cnf",
+        default=str(CRAWLER_CNF),
+        help="クローラのDBの接続設定ファイル",
+    )
+    add_boundary_arguments(parser)
+    args = parser.parse_args()
+    source = args.source
+    csv_file = args.csv_file
+    state_file = f"{csv_file}.state"
+
+    try:
+        japan = boundary_index_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f"Error loading boundaries: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        crawler_conn = mysql.connector.connect(option_files=args.crawler_cnf)
+    except mysql.connector.Error as e:
+        print(f"MySQL Error: {e}")
+        sys.exit(1)
+
+    if types_missing(crawler_conn, source):
+        print(
+            f"[!] {SOURCES[source]['table']}_types is empty:"
+            f" run crawler/backfill_types.py {source} first.",
+            file=sys.stderr,
+        )
+        crawler_conn.close()
+        sys.exit(1)
+
+    since = None
+    if args.incremental and os.path.exists(csv_file):
+        since = load_state(state_file).get("exported_at")
+    if since and not has_updated_at(crawler_conn, source):
+        print(
+            f"[!] {SOURCES[source]['table']}.updated_at does not exist yet,"
+            " exporting all rows.",
+            file=sys.stderr,
+        )
+        since = None
+    with crawler_conn.cursor() as cur:
+        cur.execute("SELECT NOW()")
+        exported_at = cur.fetchone()[0].strftime("%Y-%m-%d %H:%M:%S")
+
+    tmp_file = f"{csv_file}.tmp"
+    n_rows = 0  # Number of crawled rows read
+    n_written = 0  # Number of CSV rows written
+    try:
+        with open(tmp_file, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            exported = export_rows(
+                source, iter_crawled_rows(crawler_conn, source, since), japan
+            )
+            if since:
+                # 更新された行を先に変換し、既存のCSVの該当IDの行と差し替える
+                changed = dict(exported)
+                n_rows = len(changed)
+                with open(csv_file, encoding="utf-8", newline="") as old:
+                    for row in csv.DictReader(old):
+                        if int(row["raw_remote_id"]) not in changed:
+                            writer.writerow(row)
+                            n_written += 1
+                for rows in changed.values():
+                    writer.writerows(rows)
+                    n_written += len(rows)
+            else:
+                for _, rows in exported:
+                    n_rows += 1
+                    writer.writerows(rows)
+                    n_written += len(rows)
+        os.replace(tmp_file, csv_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        crawler_conn.close()
+
+    with open(state_file, "w", encoding="utf-8") as f:
+        json.dump({"exported_at": exported_at}, f)
+    mode = f"changed since {since}" if since else "all"
+    print(
+        f"[*] {source}: {n_rows} rows read ({mode}), {n_written} CSV rows written",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+# __END__
@@ -10,6 +10,7 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 import mysql.connector
+from shared import PointKDTree
 
 # コマンドライン引数の解析
 parser = ArgumentParser(description="POIのCSVファイルをDBに登録")
@@ -33,13 +34,36 @@ try:
     my_cnf = Path(sys.prefix).parent / ".my.cnf"
     conn = mysql.connector.connect(
         option_files=str(my_cnf),
-        autocommit=True,
+        autocommit=False,
     )
     cursor = conn.cursor(dictionary=True)
 except mysql.connector.Error as err:
     print(f"MySQL Error: {err}")
     sys.exit(1)
 
+# 登録済みの地点を一度だけ読み込み、最近傍探索の KD-tree を作る
+try:
+    cursor.execute(f"""
+        SELECT
+            source_uuid,
+            names_json->>'$[0].name' AS name,
+            ST_Longitude(geom) AS lon,
+            ST_Latitude(geom) AS lat
+        FROM {table_name}
+        WHERE geom IS NOT NULL
+        """)
+    tree = PointKDTree(
+        (row["lon"], row["lat"], (bytes(row["source_uuid"]), row["name"]))
+        for row in cursor.fetchall()
+    )
+except mysql.connector.Error as err:
+    print(f"MySQL Error: {err}")
+    sys.exit(1)
+print(f"Loaded {len(tree)} points from {table_name}")
+
+# 別名ごとに半径 radius 以内の最も近い地点を探す
+values = []
+registered = []
 with open(args.csv_file, "r", encoding="utf-8-sig") as f:
     reader = csv.DictReader(f)
     for row in reader:
@@ -58,49 +82,35 @@ with open(args.csv_file, "r", encoding="utf-8-sig") as f:
             continue
         assert abs(float(lon)) <= 180.0, f"Error: Out of range longitude value: {lon}"
         assert abs(float(lat)) <= 90.0, f"Error: Out of range latitude value: {lat}"
-        coord = f"POINT({lon} {lat})"
-        cursor.execute(
-            f"""
-            SELECT
-                source_uuid,
-                names_json->>'$[0].name' AS name,
-                ST_Distance_Sphere(
-                    geom,
-                    ST_GeomFromText(%s, 4326, "axis-order=long-lat")
-                ) AS distance_m
-            FROM {table_name}
-            WHERE
-                ST_Within(
-                    geom,
-                    ST_Buffer(
-                        ST_GeomFromText(%s, 4326, "axis-order=long-lat"),
-                        %s
-                    )
-                )
-            ORDER BY distance_m ASC
-            LIMIT 1
-            """,
-            (coord, coord, radius),
-        )
-        result = cursor.fetchone()
+        result = tree.nearest(float(lon), float(lat), radius)
         if not result:
             print(
                 f"Skipping {alias_name} ({lat}, {lon}) due to no matching result found "
             )
             continue
 
-        result_uuid = result["source_uuid"]
-        result_name = result["name"]
-        cursor.execute(
-            f"""
-            UPDATE {table_name}
-            SET names_json = JSON_ARRAY_APPEND(names_json, '$', CAST(%s AS JSON))
-            WHERE source_uuid = %s
-                AND NOT JSON_CONTAINS(names_json, CAST(%s AS JSON), '$')
-            """,
-            (alias, result_uuid, alias),
-        )
-        print(f"Registered alias for: {alias_name} -> {result_name}")
+        (result_uuid, result_name), distance_m = result
+        values.append((alias, result_uuid, alias))
+        registered.append(f"{alias_name} -> {result_name} ({distance_m:.0f} m)")
+
+# 別名の追加は1トランザクションでまとめて登録
+try:
+    cursor.executemany(
+        f"""
+        UPDATE {table_name}
+        SET names_json = JSON_ARRAY_APPEND(names_json, '$', CAST(%s AS JSON))
+        WHERE source_uuid = %s
+            AND NOT JSON_CONTAINS(names_json, CAST(%s AS JSON), '$')
+        """,
+        values,
+    )
+    conn.commit()
+except mysql.connector.Error as err:
+    print(f"MySQL Error during alias update: {err}")
+    conn.rollback()
+    sys.exit(1)
+for line in registered:
+    print(f"Registered alias for: {line}")
 
 cursor.close()
 conn.close()
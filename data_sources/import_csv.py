@@ -7,6 +7,7 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 import mysql.connector
+from shared import ChunkedLoader, ImportFingerprint
 
 # コマンドライン引数の解析
 parser = ArgumentParser(description="CSVファイルをDBに登録")
@@ -15,6 +16,26 @@ parser.add_argument("table_name", help="登録先のテーブル名")
 parser.add_argument(
     "-t", "--truncate", action="store_true", help="登録前にテーブルを空にする"
 )
+parser.add_argument(
+    "-m",
+    "--max-count",
+    type=int,
+    default=10000,
+    help="1トランザクションで登録する行数 (デフォルト: 10000)",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=4,
+    help="並列に登録する接続数 (デフォルト: 4)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="前回の取込と同じファイルでも取り込む",
+)
 args = parser.parse_args()
 csv_file = args.csv_file
 table_name = args.table_name
@@ -32,7 +53,23 @@ except mysql.connector.Error as err:
     print(f"MySQL Error: {err}")
     sys.exit(1)
 
+# 前回と同じファイルなら取込を省略
+try:
+    fingerprint = ImportFingerprint(conn, table_name, csv_file)
+    if not args.force and fingerprint.matches():
+        print(
+            f"{csv_file} is unchanged since the last import into {table_name}, skipping."
+        )
+        sys.exit(0)
+except FileNotFoundError:
+    print(f"File not found: {csv_file}")
+    sys.exit(1)
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
 # テーブルを空にする
+fingerprint.forget(replace=truncate)
 if truncate:
     try:
         cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
@@ -43,25 +80,32 @@ if truncate:
         print(f"MySQL Error during truncation: {err}")
         sys.exit(1)
 
-# CSVファイルの読み込み
+# CSVファイルの読み込みと登録 (チャンクごとに複数の接続で並列に登録)
 with open(args.csv_file, "r", encoding="utf-8-sig") as f:
     reader = csv.DictReader(f)
     fieldnames = reader.fieldnames
-    values = [tuple(row.values()) for row in reader]
-
-try:
     columns = ",".join([f"`{name}`" for name in fieldnames])
     placeholders = ",".join(["%s"] * len(fieldnames))
-    cursor.executemany(
-        f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})", values
+    loader = ChunkedLoader(
+        f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})",
+        workers=args.jobs,
+        batch_size=args.max_count,
+        label=f"rows into {table_name}",
     )
-    conn.commit()
-    print(f"{cursor.rowcount} rows inserted into {table_name}.")
-except mysql.connector.Error as err:
-    print(f"MySQL Error during insert: {err}")
-    conn.rollback()
+    count, n_failed = loader.load(tuple(row.values()) for row in reader)
+print(f"{count} rows inserted into {table_name}.")
+if n_failed:
+    # 失敗するまでにコミットしたチャンクは残る (ChunkedLoader を参照)
+    print(
+        f"Import into {table_name} failed part way; {count} rows were committed.",
+        file=sys.stderr,
+    )
+else:
+    fingerprint.record(replace=truncate)
 
 cursor.close()
 conn.close()
+if n_failed:
+    sys.exit(1)
 
 # __END__
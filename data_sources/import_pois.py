@@ -4,13 +4,19 @@
 # POI CSVファイルをDBに登録
 
 import csv
+import hashlib
 import json
+import os
+import re
 import sys
+import tempfile
 from argparse import ArgumentParser
+from itertools import groupby
 from pathlib import Path
 from uuid import UUID
 
 import mysql.connector
+from shared import ChunkedLoader, ImportFingerprint, point_wkb
 
 # コマンドライン引数の解析
 parser = ArgumentParser(description="POIのCSVファイルをDBに登録")
@@ -23,14 +29,49 @@ parser.add_argument(
     default=100000,
     help="一括登録する行数の上限 (デフォルト: 100000)",
 )
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=4,
+    help="並列に登録する接続数 (デフォルト: 4)",
+)
 parser.add_argument(
     "-t", "--truncate", action="store_true", help="登録前にテーブルを空にする"
 )
+parser.add_argument(
+    "-b",
+    "--bulk",
+    action="store_true",
+    help="LOAD DATA LOCAL INFILE で別テーブルに一括登録し、テーブルごと入れ替える",
+)
+parser.add_argument(
+    "-d",
+    "--delta",
+    action="store_true",
+    help="既存の行と source_uuid ごとのハッシュを比べ、追加・更新・削除だけを反映する",
+)
+parser.add_argument(
+    "-c",
+    "--changes",
+    help="--delta で変更・削除された source_uuid を記録するJSONファイル (unify_pois.py 用)",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="前回の取込と同じファイルでも取り込む",
+)
 args = parser.parse_args()
 csv_file = args.csv_file
 table_name = args.table_name
 max_count = args.max_count
 truncate = args.truncate
+jobs = args.jobs
+bulk = args.bulk
+delta = args.delta
+changes_file = args.changes
+source_type = re.sub(r"^stg_|_pois$", "", table_name).upper()
 
 # MySQL接続の確立
 try:
@@ -38,13 +79,319 @@ try:
     conn = mysql.connector.connect(
         option_files=str(my_cnf),
         autocommit=False,
+        allow_local_infile=bulk,
     )
     cursor = conn.cursor(dictionary=True)
 except mysql.connector.Error as e:
     print(f"MySQL Error: {e}")
     sys.exit(1)
 
+
+def ensure_row_hash_column():
+    # 差分取込に使う row_hash 列が無ければ追加する
+    cursor.execute(
+        """
+        SELECT COUNT(*) AS n FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            AND COLUMN_NAME = 'row_hash'
+        """,
+        (table_name,),
+    )
+    if not cursor.fetchone()["n"]:
+        cursor.execute(
+            f"ALTER TABLE {table_name} ADD COLUMN row_hash BINARY(16)"
+            " COMMENT '取込データのハッシュ' AFTER last_updated_at"
+        )
+        print(f"Added row_hash column to {table_name}")
+
+
+def touch_last_imported():
+    cursor.execute(
+        """
+        UPDATE digital_service_details AS d
+        JOIN information_sources AS s ON s.id = d.source_id
+        SET d.last_imported_at = NOW()
+        WHERE s.display_name = %s
+        """,
+        (source_type,),
+    )
+
+
+def write_changes(changed, deleted):
+    # 前回の変更集合が未処理で残っていれば合わせて記録する
+    old = {"changed": [], "deleted": []}
+    if os.path.exists(changes_file):
+        with open(changes_file, encoding="utf-8") as f:
+            old = json.load(f)
+    changed = {u.hex() for u in changed}
+    deleted = {u.hex() for u in deleted}
+    data = {
+        "table": table_name,
+        "changed": sorted((set(old["changed"]) - deleted) | changed),
+        "deleted": sorted((set(old["deleted"]) - changed) | deleted),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(changes_file)), exist_ok=True)
+    with open(changes_file, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+try:
+    ensure_row_hash_column()
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
+# 前回と同じファイルなら取込を省略
+try:
+    fingerprint = ImportFingerprint(conn, table_name, csv_file)
+    if not args.force and fingerprint.matches():
+        print(
+            f"{csv_file} is unchanged since the last import into {table_name}, skipping."
+        )
+        if delta and changes_file:
+            # 変更集合が無いと unify_pois.py が全件を処理し直すので、空の集合を残す
+            write_changes([], [])
+        sys.exit(0)
+except FileNotFoundError:
+    print(f"File not found: {csv_file}")
+    sys.exit(1)
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
+
+def group_pois(reader):
+    # 別名ごとのCSV行を source_uuid ごとに1件へまとめる (連続した行を逐次集約)
+    # 変換スクリプトは同じ source_uuid の行を続けて出力する。離れた位置に
+    # 同じ source_uuid が現れたら、先に登録した別名を失わないよう ValueError
+    seen = set()
+    for source_uuid, rows in groupby(reader, key=lambda row: row["source_uuid"]):
+        if not source_uuid:  # 別名はスキップ
+            continue
+        if source_uuid in seen:
+            raise ValueError(
+                f"source_uuid {source_uuid} の行が連続していません"
+                " (同じ source_uuid の行を続けて並べてください)"
+            )
+        seen.add(source_uuid)
+        rows = list(rows)
+        names = [{"name": row["name"], "kana": row["kana"]} for row in rows]
+        poi = {**rows[0], "names": names}
+        poi["row_hash"] = row_hash(poi)
+        yield poi
+
+
+def row_hash(poi):
+    # 登録する列の値から作るハッシュ (差分取込で変更の有無を判定する)
+    data = [
+        poi["raw_remote_id"],
+        poi["names"],
+        poi["lon"],
+        poi["lat"],
+        poi["elevation_m"],
+        poi["poi_type_raw"],
+        poi["last_updated_at"],
+    ]
+    return hashlib.md5(json.dumps(data, ensure_ascii=False).encode()).digest()
+
+
+def poi_row(poi):
+    uuid = UUID(poi["source_uuid"])
+    names_json = json.dumps(poi["names"], ensure_ascii=False)
+    lon = poi["lon"]
+    lat = poi["lat"]
+    coord = point_wkb(lon, lat) if lon and lat else None
+    return (
+        uuid.bytes,
+        poi["raw_remote_id"],
+        names_json,
+        coord,
+        poi["elevation_m"] or None,
+        poi["poi_type_raw"],
+        poi["last_updated_at"] or None,
+        poi["row_hash"],
+    )
+
+
+# poi_row() の行を登録する (同じ source_uuid の行は置き換える)
+upsert_sql = f"""
+    INSERT INTO {table_name} (
+        source_uuid, raw_remote_id, names_json,
+        geom, elevation_m, poi_type_raw, last_updated_at, row_hash
+    ) VALUES (
+        %s, %s, %s,
+        ST_GeomFromWKB(%s, 4326, "axis-order=long-lat"), %s, %s, %s, %s
+    )
+    ON DUPLICATE KEY UPDATE
+        raw_remote_id = VALUES(raw_remote_id),
+        names_json = VALUES(names_json),
+        geom = VALUES(geom),
+        elevation_m = VALUES(elevation_m),
+        poi_type_raw = VALUES(poi_type_raw),
+        last_updated_at = VALUES(last_updated_at),
+        row_hash = VALUES(row_hash)
+    """
+
+
+def mysql_field(value):
+    # LOAD DATA の既定の書式 (タブ区切り、\ でエスケープ、\N はNULL)
+    if value is None or value == "":
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def bulk_load(pois):
+    # 1. source_uuid ごとに1行の一時ファイルを作成
+    # 2. LOAD DATA LOCAL INFILE で空間索引のない影テーブルに読み込む
+    # 3. 空間索引を一度だけ作成
+    # 4. RENAME TABLE で本テーブルと入れ替える (読み手に途中の状態は見えない)
+    shadow_table = f"{table_name}_new"
+    old_table = f"{table_name}_old"
+    count = 0
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", newline="\n", suffix=".tsv"
+    ) as tmp:
+        for poi in pois:
+            lon = poi["lon"]
+            lat = poi["lat"]
+            fields = [
+                UUID(poi["source_uuid"]).hex,
+                poi["raw_remote_id"],
+                json.dumps(poi["names"], ensure_ascii=False),
+                point_wkb(lon, lat).hex() if lon and lat else None,
+                poi["elevation_m"],
+                poi["poi_type_raw"],
+                poi["last_updated_at"],
+                poi["row_hash"].hex(),
+            ]
+            tmp.write("\t".join(mysql_field(v) for v in fields) + "\n")
+            count += 1
+        tmp.flush()
+
+        try:
+            cursor.execute(f"DROP TABLE IF EXISTS {shadow_table}, {old_table}")
+            cursor.execute(f"CREATE TABLE {shadow_table} LIKE {table_name}")
+            cursor.execute(
+                """
+                SELECT DISTINCT INDEX_NAME AS index_name, COLUMN_NAME AS column_name
+                FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                    AND INDEX_TYPE = 'SPATIAL'
+                """,
+                (shadow_table,),
+            )
+            spatial_indexes = cursor.fetchall()
+            for index in spatial_indexes:
+                cursor.execute(
+                    f"ALTER TABLE {shadow_table} DROP INDEX `{index['index_name']}`"
+                )
+            cursor.execute(
+                f"""
+                LOAD DATA LOCAL INFILE %s
+                INTO TABLE {shadow_table}
+                CHARACTER SET utf8mb4
+                (@source_uuid, raw_remote_id, names_json, @wkb,
+                    elevation_m, poi_type_raw, last_updated_at, @row_hash)
+                SET
+                    source_uuid = UNHEX(@source_uuid),
+                    row_hash = UNHEX(@row_hash),
+                    geom = ST_GeomFromWKB(UNHEX(@wkb), 4326, "axis-order=long-lat")
+                """,
+                (tmp.name,),
+            )
+            conn.commit()
+            print(f"Loaded {count} rows into {shadow_table}")
+            for index in spatial_indexes:
+                cursor.execute(f"""
+                    ALTER TABLE {shadow_table}
+                    ADD SPATIAL INDEX `{index['index_name']}` ({index['column_name']})
+                    """)
+            cursor.execute(f"""
+                RENAME TABLE {table_name} TO {old_table},
+                    {shadow_table} TO {table_name}
+                """)
+            cursor.execute(f"DROP TABLE {old_table}")
+            touch_last_imported()
+            conn.commit()
+            print(f"Swapped {shadow_table} into {table_name}")
+        except mysql.connector.Error as e:
+            print(f"MySQL Error during bulk load: {e}")
+            conn.rollback()
+            sys.exit(1)
+
+
+def delta_load(pois):
+    # 既存の行の row_hash と比べ、追加・更新・削除を1トランザクションで反映する
+    cursor.execute(f"SELECT source_uuid, row_hash FROM {table_name}")
+    existing = {bytes(row["source_uuid"]): row["row_hash"] for row in cursor}
+    inserted = []
+    updated = []
+    values = []
+    for poi in pois:
+        uuid = UUID(poi["source_uuid"]).bytes
+        if uuid not in existing:
+            inserted.append(uuid)
+        elif existing.pop(uuid) != poi["row_hash"]:
+            updated.append(uuid)
+        else:
+            continue
+        values.append(poi_row(poi))
+    deleted = list(existing)
+
+    try:
+        for i in range(0, len(values), max_count):
+            cursor.executemany(upsert_sql, values[i : i + max_count])
+        for i in range(0, len(deleted), max_count):
+            cursor.executemany(
+                f"DELETE FROM {table_name} WHERE source_uuid = %s",
+                [(uuid,) for uuid in deleted[i : i + max_count]],
+            )
+        touch_last_imported()
+        conn.commit()
+    except mysql.connector.Error as e:
+        print(f"MySQL Error during delta import: {e}")
+        conn.rollback()
+        sys.exit(1)
+
+    print(
+        f"{table_name}: {len(inserted)} inserted, {len(updated)} updated,"
+        f" {len(deleted)} deleted"
+    )
+    if changes_file:
+        write_changes(inserted + updated, deleted)
+
+
+if bulk or delta:
+    try:
+        with open(csv_file, "r", encoding="utf-8-sig") as f:
+            suffix = Path(csv_file).suffix.lower()
+            delimiter = "\t" if suffix == ".tsv" else ","
+            pois = group_pois(csv.DictReader(f, delimiter=delimiter))
+            if delta:
+                delta_load(pois)
+            else:
+                bulk_load(pois)
+        fingerprint.record(replace=True)
+    except FileNotFoundError:
+        print(f"File not found: {csv_file}")
+    except csv.Error as e:
+        print(f"CSV Error: {e}")
+    except ValueError as e:
+        print(f"CSV Error: {e}")
+        conn.rollback()
+        sys.exit(1)
+    cursor.close()
+    conn.close()
+    sys.exit(0)
+
 # テーブルを空にする
+fingerprint.forget(replace=truncate)
 if truncate:
     try:
         cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
@@ -57,75 +404,43 @@ if truncate:
         sys.exit(1)
 
 
-def insert_poi_data(values):
-    try:
-        cursor.executemany(
-            f"""
-            INSERT INTO {table_name} (
-                source_uuid, raw_remote_id, names_json,
-                geom, elevation_m, poi_type_raw, last_updated_at
-            ) VALUES (
-                %s, %s, %s,
-                ST_GeomFromText(%s, 4326, "axis-order=long-lat"), %s, %s, %s
-            )
-            ON DUPLICATE KEY UPDATE
-                names_json = JSON_MERGE_PRESERVE(names_json, VALUES(names_json))
-            """,
-            values,
-        )
-        conn.commit()
-    except mysql.connector.Error as e:
-        print(f"MySQL Error during insertion: {e}")
-        conn.rollback()
-        sys.exit(1)
-
+# max_count 行ごとのチャンクを jobs 本の接続で並列に登録
+loader = ChunkedLoader(
+    upsert_sql,
+    workers=jobs,
+    batch_size=max_count,
+    label=f"rows into {table_name}",
+)
 
 # CSVファイルの読み込み
+n_failed = 0
 try:
     with open(csv_file, "r", encoding="utf-8-sig") as f:
         suffix = Path(csv_file).suffix.lower()
         delimiter = "\t" if suffix == ".tsv" else ","
         reader = csv.DictReader(f, delimiter=delimiter)
-        count = 0
-        values = []
-        for row in reader:
-            source_uuid = row["source_uuid"]
-            if not source_uuid:  # 別名はスキップ
-                continue
-            uuid = UUID(source_uuid)
-            name = row["name"]
-            kana = row["kana"]
-            names_json = json.dumps([{"name": name, "kana": kana}], ensure_ascii=False)
-            lon = row["lon"]
-            lat = row["lat"]
-            coord = f"POINT({lon} {lat})" if lon and lat else None
-            values.append(
-                (
-                    uuid.bytes,
-                    row["raw_remote_id"],
-                    names_json,
-                    coord,
-                    row["elevation_m"] or None,
-                    row["poi_type_raw"],
-                    row["last_updated_at"] or None,
-                )
-            )
-            count += 1
-            if count % max_count == 0:
-                insert_poi_data(values)
-                print(f"Inserted {count} rows into {table_name}")
-                values = []
-
-    if values:
-        insert_poi_data(values)
-        print(f"Inserted {count} rows into {table_name}")
+        count, n_failed = loader.load(map(poi_row, group_pois(reader)))
+    if not n_failed:
+        touch_last_imported()
+        conn.commit()
+        fingerprint.record(replace=truncate)
 
 except FileNotFoundError:
     print(f"File not found: {csv_file}")
 except csv.Error as e:
     print(f"CSV Error: {e}")
+except ValueError as e:
+    print(f"CSV Error: {e}")
+    n_failed += 1
 
 cursor.close()
 conn.close()
+if n_failed:
+    # 失敗するまでにコミットしたチャンクは残る (再実行すると上書きで揃う)
+    print(
+        f"Import into {table_name} failed part way; rerun to complete it.",
+        file=sys.stderr,
+    )
+    sys.exit(1)
 
 # __END__
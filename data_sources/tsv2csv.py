@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 # YAMAP/Yamareco TSVファイルをCSV形式に変換して出力するスクリプト
+# (変換処理は export_crawler.py と共用)
+# 国外の地点の判定は行政区域境界から作ったメモリ上の格子索引で行う (DBは使わない)
 
 import csv
 import html
@@ -11,97 +13,125 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 import jaconv
-import mysql.connector
 from shared import extract_aliases
 from shared import generate_source_uuid
+from shared import load_boundary_index
 
-parser = ArgumentParser(description="YAMAP/YamarecoのTSVファイルを変換してCSV出力")
-parser.add_argument(
-    "source",
-    choices=["yamap", "yamareco"],
-    help="データソース（yamap または yamareco）を指定",
-)
-parser.add_argument("tsv_file", help="TSVファイルのパス")
-args = parser.parse_args()
-source = args.source
-tsv_file = args.tsv_file
-
-try:
-    my_cnf = Path(sys.prefix).parent / ".my.cnf"
-    conn = mysql.connector.connect(
-        option_files=str(my_cnf),
-        autocommit=False,
+FIELDNAMES = [
+    "source_uuid",
+    "raw_remote_id",
+    "name",
+    "kana",
+    "lat",
+    "lon",
+    "elevation_m",
+    "poi_type_raw",
+    "last_updated_at",
+]
+
+
+BASE_DIR = Path(__file__).resolve().parent
+INDEX_CACHE = BASE_DIR / "administrative" / "work" / "japan_index.pickle"
+
+
+def add_boundary_arguments(parser):
+    # 境界の版は administrative/Makefile の REVISION に従う (Makefile から渡す)
+    parser.add_argument(
+        "--boundaries",
+        required=True,
+        help="行政区域境界のGeoJSONファイル、またはそれを含むZIPファイルのパス",
+    )
+    parser.add_argument(
+        "--index-cache",
+        default=str(INDEX_CACHE),
+        help="境界の索引のキャッシュファイル (空文字列で使わない)",
+    )
+
+
+def boundary_index_from_args(args):
+    return load_boundary_index(args.boundaries, args.index_cache or None)
+
+
+def is_in_japan(japan, lon, lat):
+    return japan.contains(lon, lat)
+
+
+def convert_row(source, row, japan):
+    # クロール結果の1行を別名ごとのCSV行に変換 (範囲外・国外の地点は空)
+    name = html.unescape(row["name"].strip())
+    if name.startswith("（") and name.endswith("）"):
+        name = name[1:-1]
+    data = json.loads(row["kana"])
+    hira = data.get("hira", "")
+    kana = jaconv.kata2hira(hira) if hira else ""
+
+    lon = float(row["lon"])
+    lat = float(row["lat"])
+    if lon and lat:
+        if not (abs(lon) <= 180.0 and abs(lat) <= 90.0):
+            print(
+                f"Warning: {name} ({lat:.6f}, {lon:.6f}) is outside valid range.",
+                file=sys.stderr,
+            )
+            return []
+        if not is_in_japan(japan, lon, lat):
+            print(
+                f"Warning: {name} ({lat:.6f}, {lon:.6f}) is outside Japan.",
+                file=sys.stderr,
+            )
+            return []
+
+    row = dict(row)
+    if row["elevation_m"] in ("NULL", None):
+        row["elevation_m"] = ""
+
+    raw_remote_id = row["raw_remote_id"]
+    row["source_uuid"] = generate_source_uuid(f"{source}_poi", raw_remote_id)
+    rows = []
+    for n, k in extract_aliases(name, kana):
+        rows.append({**row, "name": n, "kana": k})
+    return rows
+
+
+def main():
+    parser = ArgumentParser(description="YAMAP/YamarecoのTSVファイルを変換してCSV出力")
+    parser.add_argument(
+        "source",
+        choices=["yamap", "yamareco"],
+        help="データソース（yamap または yamareco）を指定",
     )
-    cursor = conn.cursor(dictionary=True)
-except mysql.connector.Error as e:
-    print(f"MySQL Error: {e}")
-    sys.exit(1)
-
-try:
-    with open(tsv_file, "r", encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        fieldnames = ["source_uuid"] + reader.fieldnames
-        writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            name = html.unescape(row["name"].strip())
-            if name.startswith("（") and name.endswith("）"):
-                name = name[1:-1]
-            data = json.loads(row["kana"])
-            hira = data.get("hira", "")
-            kana = jaconv.kata2hira(hira) if hira else ""
-
-            lon = float(row["lon"])
-            lat = float(row["lat"])
-            if lon and lat:
-                if not (abs(lon) <= 180.0 and abs(lat) <= 90.0):
-                    print(
-                        f"Warning: {name} ({lat:.6f}, {lon:.6f}) is outside valid range.",
-                        file=sys.stderr,
-                    )
-                    continue
-                coord = f"POINT({lon:.6f} {lat:.6f})"
-                cursor.execute(
-                    f"""
-                    SELECT EXISTS (
-                        SELECT 1
-                        FROM administrative_boundaries 
-                        WHERE ST_Contains(
-                            geom,
-                            ST_GeomFromText(%s, 4326, "axis-order=long-lat")
-                        )
-                    ) AS is_japan;
-                    """,
-                    (coord,),
-                )
-                result = cursor.fetchone()
-                if not result["is_japan"]:
-                    print(
-                        f"Warning: {name} ({lat:.6f}, {lon:.6f}) is outside Japan.",
-                        file=sys.stderr,
-                    )
-                    continue
-
-            if row["elevation_m"] == "NULL":
-                row["elevation_m"] = ""
-
-            raw_remote_id = row["raw_remote_id"]
-            row["source_uuid"] = generate_source_uuid(f"{source}_poi", raw_remote_id)
-            for n, k in extract_aliases(name, kana):
-                row["name"] = n
-                row["kana"] = k
-                writer.writerow(row)
-
-except FileNotFoundError:
-    print(f"Error: '{tsv_file}' not found.", file=sys.stderr)
-except csv.Error as e:
-    print(f"CSV Error: {e}", file=sys.stderr)
-except json.JSONDecodeError as e:
-    print(f"JSON Decode Error: {e}", file=sys.stderr)
-except Exception as e:
-    print(f"Error processing file: {e}", file=sys.stderr)
-finally:
-    cursor.close()
-    conn.close()
+    parser.add_argument("tsv_file", help="TSVファイルのパス")
+    add_boundary_arguments(parser)
+    args = parser.parse_args()
+    source = args.source
+    tsv_file = args.tsv_file
+
+    try:
+        japan = boundary_index_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f"Error loading boundaries: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(tsv_file, "r", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            fieldnames = ["source_uuid"] + reader.fieldnames
+            writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in reader:
+                writer.writerows(convert_row(source, row, japan))
+
+    except FileNotFoundError:
+        print(f"Error: '{tsv_file}' not found.", file=sys.stderr)
+    except csv.Error as e:
+        print(f"CSV Error: {e}", file=sys.stderr)
+    except json.JSONDecodeError as e:
+        print(f"JSON Decode Error: {e}", file=sys.stderr)
+    except Exception as e:
+        print(f"Error processing file: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
 
 # __END__
@@ -7,6 +7,7 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 import mysql.connector
+from shared import ImportFingerprint, point_wkb
 
 parser = ArgumentParser(description="統一POIテーブルを初期化")
 parser.add_argument("csv_file", help="ジオメトリ情報を含むCSVファイル")
@@ -14,6 +15,12 @@ parser.add_argument("table_name", help="統一POIテーブル名")
 parser.add_argument(
     "-t", "--truncate", action="store_true", help="テーブルを空にしてから登録"
 )
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="前回の取込と同じファイルでも取り込む",
+)
 args = parser.parse_args()
 csv_file = args.csv_file
 table_name = args.table_name
@@ -34,6 +41,22 @@ except mysql.connector.Error as e:
     print(f"MySQL Error: {e}")
     sys.exit(1)
 
+# 前回と同じファイルなら取込を省略
+try:
+    fingerprint = ImportFingerprint(conn, table_name, csv_file)
+    if not args.force and fingerprint.matches():
+        print(
+            f"{csv_file} is unchanged since the last import into {table_name}, skipping."
+        )
+        sys.exit(0)
+except FileNotFoundError:
+    print(f"File not found: {csv_file}")
+    sys.exit(1)
+except mysql.connector.Error as e:
+    print(f"MySQL Error: {e}")
+    sys.exit(1)
+
+fingerprint.forget(replace=truncate)
 if truncate:
     try:
         cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
@@ -61,7 +84,7 @@ try:
             lat = row["lat"]
             lon = row["lon"]
             alt = row["alt"]
-            values.append((category_id, name, kana, f"POINT({lon} {lat})", alt))
+            values.append((category_id, name, kana, point_wkb(lon, lat), alt))
 
     cursor.executemany(
         f"""
@@ -70,13 +93,14 @@ try:
             representative_geom, elevation_m
         ) VALUES (
             %s, %s, %s,
-            ST_GeomFromText(%s, 4326, "axis-order=long-lat"), %s
+            ST_GeomFromWKB(%s, 4326, "axis-order=long-lat"), %s
         )
         """,
         values,
     )
     conn.commit()
     print(f"Inserted {cursor.rowcount} rows into {table_name}")
+    fingerprint.record(replace=truncate)
 
 except FileNotFoundError:
     print(f"CSVファイルが見つかりません: {csv_file}")
@@ -56,7 +56,7 @@ for row in cursor.fetchall():
         FROM (
             SELECT DISTINCT r.pref_name, r.jis_code
             FROM unified_pois AS u
-            JOIN administrative_boundaries AS b ON ST_Intersects(b.geom, ST_Buffer(u.representative_geom, %s))
+            JOIN administrative_boundary_cells AS b ON ST_Intersects(b.geom, ST_Buffer(u.representative_geom, %s))
             JOIN administrative_regions AS r USING (jis_code)
             WHERE u.id = %s
             ORDER BY r.jis_code
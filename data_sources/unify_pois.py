@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import json
+import os
 import re
 import sys
 from argparse import ArgumentParser
@@ -31,11 +32,30 @@ parser.add_argument(
     default=10000,
     help="バッファの半径[m] (デフォルト: 10000)",
 )
+parser.add_argument(
+    "-c",
+    "--changes",
+    help="import_pois.py --delta の変更集合 (JSON)。あれば変更・削除された行のリンクだけを作り直す",
+)
 args = parser.parse_args()
 table_name = args.table_name
 source_type = re.sub(r"^stg_|_pois$", "", table_name).upper()
 radius = args.radius
 
+# 変更集合の読み込み (無ければ全件を処理)
+changed = None
+if args.changes and os.path.exists(args.changes):
+    with open(args.changes, encoding="utf-8") as f:
+        changes = json.load(f)
+    if changes["table"] != table_name:
+        print(f"{args.changes} is a change set of {changes['table']}, not {table_name}")
+        sys.exit(1)
+    changed = {bytes.fromhex(u) for u in changes["changed"]}
+    deleted = {bytes.fromhex(u) for u in changes["deleted"]}
+    print(f"Change set: {len(changed)} changed, {len(deleted)} deleted")
+    if not (changed or deleted):
+        sys.exit(0)
+
 # MySQL接続の確立
 try:
     my_cnf = Path(sys.prefix).parent / ".my.cnf"
@@ -96,7 +116,13 @@ cursor.execute("""
 mt_ranges = {row["parent_name"]: row["parent_id"] for row in cursor.fetchall()}
 
 # 既存のリンクを削除
-cursor.execute("DELETE FROM poi_links WHERE source_type = %s", (source_type,))
+if changed is None:
+    cursor.execute("DELETE FROM poi_links WHERE source_type = %s", (source_type,))
+else:
+    cursor.executemany(
+        "DELETE FROM poi_links WHERE source_type = %s AND source_uuid = %s",
+        [(source_type, uuid) for uuid in changed | deleted],
+    )
 conn.commit()
 
 # POIごとに処理
@@ -121,6 +147,8 @@ else:
 total = 0  # 一致したPOIのカウント
 for row in cursor.fetchall():
     source_uuid = row["source_uuid"]
+    if changed is not None and bytes(source_uuid) not in changed:
+        continue
     if table_name == "stg_book_pois":
         source_id = row["source_id"]
     names_json = json.loads(row["names_json"])
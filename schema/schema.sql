@@ -44,6 +44,14 @@ CREATE TABLE administrative_boundaries (
     SPATIAL INDEX(geom)
 ) COMMENT '行政区画境界データ';
 
+CREATE TABLE administrative_boundary_cells (
+    id INT AUTO_INCREMENT PRIMARY KEY COMMENT 'セルID',
+    jis_code CHAR(5) COLLATE ascii_bin NOT NULL COMMENT '行政区画コード',
+    geom GEOMETRY NOT NULL /*!80003 SRID 4326 */ COMMENT '格子で分割した境界ジオメトリ',
+    FOREIGN KEY (jis_code) REFERENCES administrative_regions(jis_code),
+    SPATIAL INDEX(geom)
+) COMMENT '行政区画境界データ（格子分割）';
+
 CREATE TABLE poi_categories (
     id VARCHAR(20) COLLATE ascii_bin PRIMARY KEY COMMENT '種別ID',
     display_name VARCHAR(50) NOT NULL COMMENT '表示名称',
@@ -59,6 +67,7 @@ CREATE TABLE stg_gsi_dm25k_pois (
     -- 個別の属性
     poi_type_raw VARCHAR(50) COMMENT '大分類-中分類-小分類',
     last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT '国土地理院 数値地図(地名情報)';
 
@@ -71,6 +80,7 @@ CREATE TABLE stg_gsi_vtexp_pois (
     -- 個別の属性
     poi_type_raw VARCHAR(50) COMMENT '注記分類',
     last_updated_at DATETIME COMMENT 'lfSpanFr',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT '国土地理院 自然地名ベクトルタイル';
 
@@ -83,6 +93,7 @@ CREATE TABLE stg_gsi_gcp_pois (
     -- 個別の属性
     poi_type_raw VARCHAR(50) COMMENT '基準点の種類',
     last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT '国土地理院 基準点データ';
 
@@ -96,6 +107,7 @@ CREATE TABLE stg_yamap_pois (
     poi_type_raw VARCHAR(50) COMMENT '元データの種別名',
     page_url VARCHAR(255) COLLATE ascii_bin COMMENT 'WebページURL',
     last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT 'YAMAP Landmarks';
 
@@ -109,6 +121,7 @@ CREATE TABLE stg_yamareco_pois (
     poi_type_raw VARCHAR(255) COMMENT '元データの種別名',
     page_url VARCHAR(255) COLLATE ascii_bin COMMENT 'WebページURL',
     last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT 'YamaReco POIデータ';
 
@@ -121,7 +134,8 @@ CREATE TABLE stg_wikidata_pois (
     -- 個別の属性
     poi_type_raw VARCHAR(50) COMMENT '元データの種別名',
     page_url VARCHAR(255) COLLATE ascii_bin COMMENT 'WebページURL',
-    last_updated_at DATETIME COMMENT 'データ更新日'
+    last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ'
 ) COMMENT 'Wikidata POIデータ';
 
 CREATE TABLE stg_legacy_pois (
@@ -133,6 +147,7 @@ CREATE TABLE stg_legacy_pois (
     -- 個別の属性
     poi_type_raw VARCHAR(50) COMMENT '種別名',
     last_updated_at DATETIME COMMENT 'データ更新日',
+    row_hash BINARY(16) COMMENT '取込データのハッシュ',
     SPATIAL INDEX(geom)
 ) COMMENT '山名一覧 on the Web地図（旧DB）';
 
@@ -233,3 +248,14 @@ CREATE TABLE poi_address_map (
     PRIMARY KEY (unified_poi_id, jis_code),
     INDEX idx_jis_code (jis_code)
 ) COMMENT 'POIと行政区画コードの紐付けテーブル';
+
+CREATE TABLE import_fingerprints (
+    table_name VARCHAR(64) COLLATE ascii_bin NOT NULL COMMENT '登録先テーブル名',
+    file_name VARCHAR(255) NOT NULL COMMENT '取込元ファイルのパス',
+    file_size BIGINT NOT NULL COMMENT 'ファイルサイズ',
+    file_mtime_ns BIGINT NOT NULL COMMENT 'ファイル更新日時[ns]',
+    file_hash BINARY(32) NOT NULL COMMENT 'SHA-256',
+    schema_version CHAR(32) COLLATE ascii_bin NOT NULL COMMENT 'テーブル定義のMD5',
+    imported_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '取込日時',
+    PRIMARY KEY (table_name, file_name)
+) COMMENT '取込元ファイルの指紋';
@@ -1,3 +1,18 @@
 __version__ = "1.0.0"
 from .generate_source_uuid import generate_source_uuid
 from .extract_aliases import extract_aliases
+from .geometry import (
+    box_wkb,
+    collection_wkb,
+    geometry_polygons,
+    grid_cells,
+    iter_features,
+    load_boundary_index,
+    open_geojson,
+    point_wkb,
+    PointKDTree,
+    polygon_wkb,
+    PolygonGridIndex,
+)
+from .fingerprint import ImportFingerprint
+from .loader import ChunkedLoader
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 取込元ファイルの指紋 (サイズ、SHA-256、登録先テーブルの定義) を import_fingerprints に
+# 記録し、前回と同じファイルなら取込を省略できるようにする
+
+import hashlib
+import os
+
+# schema/schema.sql と同じ定義 (古いDBでも使えるように無ければ作成する)
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS import_fingerprints (
+        table_name VARCHAR(64) COLLATE ascii_bin NOT NULL COMMENT '登録先テーブル名',
+        file_name VARCHAR(255) NOT NULL COMMENT '取込元ファイルのパス',
+        file_size BIGINT NOT NULL COMMENT 'ファイルサイズ',
+        file_mtime_ns BIGINT NOT NULL COMMENT 'ファイル更新日時[ns]',
+        file_hash BINARY(32) NOT NULL COMMENT 'SHA-256',
+        schema_version CHAR(32) COLLATE ascii_bin NOT NULL COMMENT 'テーブル定義のMD5',
+        imported_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '取込日時',
+        PRIMARY KEY (table_name, file_name)
+    ) COMMENT '取込元ファイルの指紋'
+    """
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.digest()
+
+
+class ImportFingerprint:
+    # table_name に path を取り込んだ記録
+    # matches(): 前回の取込と同じファイル・テーブル定義なら True
+    # record(): 取込の成功後に記録する (replace=True はテーブル全体を入れ替えた場合)
+    def __init__(self, conn, table_name, path):
+        self.conn = conn
+        self.table_name = table_name
+        self.file_name = os.path.abspath(path)
+        stat = os.stat(path)
+        self.file_size = stat.st_size
+        self.file_mtime_ns = stat.st_mtime_ns
+        self.file_hash = None
+
+    def _hash(self):
+        if self.file_hash is None:
+            self.file_hash = file_hash(self.file_name)
+        return self.file_hash
+
+    def _schema_version(self, cursor):
+        cursor.execute(
+            """
+            SELECT MD5(GROUP_CONCAT(
+                COLUMN_NAME, ' ', COLUMN_TYPE ORDER BY ORDINAL_POSITION
+            )) AS schema_version
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            """,
+            (self.table_name,),
+        )
+        return cursor.fetchone()["schema_version"]
+
+    def matches(self):
+        with self.conn.cursor(dictionary=True) as cursor:
+            cursor.execute(CREATE_TABLE)
+            cursor.execute(
+                """
+                SELECT file_size, file_mtime_ns, file_hash, schema_version
+                FROM import_fingerprints
+                WHERE table_name = %s AND file_name = %s
+                """,
+                (self.table_name, self.file_name),
+            )
+            row = cursor.fetchone()
+            if not row or row["file_size"] != self.file_size:
+                return False
+            if row["schema_version"] != self._schema_version(cursor):
+                return False
+            if row["file_mtime_ns"] == self.file_mtime_ns:
+                return True  # サイズと更新日時が同じならハッシュは計算しない
+            if bytes(row["file_hash"]) != self._hash():
+                return False
+        # 内容は同じで更新日時だけが異なる (再生成された) ので記録を更新
+        self.record()
+        return True
+
+    def record(self, replace=False):
+        with self.conn.cursor(dictionary=True) as cursor:
+            cursor.execute(CREATE_TABLE)
+            if replace:
+                # 入れ替える前に他のファイルから追加した行は残っていない
+                cursor.execute(
+                    "DELETE FROM import_fingerprints WHERE table_name = %s",
+                    (self.table_name,),
+                )
+            cursor.execute(
+                """
+                REPLACE INTO import_fingerprints (
+                    table_name, file_name, file_size, file_mtime_ns,
+                    file_hash, schema_version
+                ) VALUES (%s, %s, %s, %s, %s, %s)
+                """,
+                (
+                    self.table_name,
+                    self.file_name,
+                    self.file_size,
+                    self.file_mtime_ns,
+                    self._hash(),
+                    self._schema_version(cursor),
+                ),
+            )
+        self.conn.commit()
+
+    def forget(self, replace=False):
+        # 取込の途中で失敗するとテーブルの内容が記録と一致しなくなるので、先に消す
+        # (replace=True はテーブルを空にする場合で、他のファイルの記録も消す)
+        with self.conn.cursor(dictionary=True) as cursor:
+            cursor.execute(CREATE_TABLE)
+            if replace:
+                cursor.execute(
+                    "DELETE FROM import_fingerprints WHERE table_name = %s",
+                    (self.table_name,),
+                )
+            else:
+                cursor.execute(
+                    """
+                    DELETE FROM import_fingerprints
+                    WHERE table_name = %s AND file_name = %s
+                    """,
+                    (self.table_name, self.file_name),
+                )
+        self.conn.commit()
+
+
+# __END__
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# GeoJSONの逐次読み込み、MySQLに渡すWKBの生成、点の包含判定の格子索引
+
+import io
+import json
+import math
+import os
+import pickle
+import struct
+import zipfile
+from array import array
+from collections import defaultdict
+
+WKB_POINT = 1
+WKB_POLYGON = 3
+WKB_GEOMETRYCOLLECTION = 7
+
+EARTH_RADIUS_M = 6370986  # ST_Distance_Sphere の既定の半径
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    # テキストストリームを少しずつ読み込み、先頭から JSON の値を取り出す
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+        self.text = self.text[self.pos :] + data
+        self.pos = 0
+
+    def peek(self):
+        # 空白を読み飛ばして次の1文字を返す (終端では "")
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos : self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise json.JSONDecodeError(f"Expecting {chars!r}", self.text, self.pos)
+        self.pos += 1
+        return c
+
+    def value(self):
+        # 次の値を1つ復号する。値が途中で切れていれば読み足して再試行
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # 大きな値でも再試行が O(n^2) にならないよう、読み込み量を倍増
+                self.fill(max(self.chunk_size, len(self.text) - self.pos))
+                continue
+            if end == len(self.text) and not self.eof:
+                # 数値などは後続で続く可能性がある
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(f, chunk_size=1 << 20):
+    # FeatureCollection の features を1件ずつ返す (ファイル全体を読み込まない)
+    buf = _Buffer(f, chunk_size)
+    buf.expect("{")
+    if buf.peek() == "}":
+        return
+    while True:
+        key = buf.value()
+        buf.expect(":")
+        if key == "features":
+            buf.expect("[")
+            if buf.peek() == "]":
+                buf.pos += 1
+            else:
+                while True:
+                    yield buf.value()
+                    if buf.expect(",]") == "]":
+                        break
+        else:
+            buf.value()  # type, name, crs など
+        if buf.expect(",}") == "}":
+            return
+
+
+def open_geojson(path):
+    # GeoJSONファイル、またはGeoJSONを含むZIPファイルをテキストとして開く
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        names = [n for n in archive.namelist() if n.lower().endswith(".geojson")]
+        if not names:
+            archive.close()
+            raise FileNotFoundError(f"No GeoJSON file in {path}")
+        return io.TextIOWrapper(archive.open(names[0]), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def point_wkb(lon, lat):
+    # 経度・緯度 (数値または数値の文字列) を Point のWKBに変換
+    # (ST_GeomFromWKB(wkb, 4326, 'axis-order=long-lat') で読み込む)
+    return struct.pack("<BIdd", 1, WKB_POINT, float(lon), float(lat))
+
+
+def polygon_wkb(rings):
+    # GeoJSON の Polygon 座標 ([[lon, lat], ...] の環の配列) をWKBに変換
+    # (ST_GeomFromWKB(wkb, 4326, 'axis-order=long-lat') で読み込む)
+    parts = [struct.pack("<BII", 1, WKB_POLYGON, len(rings))]
+    for ring in rings:
+        coords = [c for point in ring for c in point[:2]]
+        parts.append(struct.pack(f"<I{len(coords)}d", len(ring), *coords))
+    return b"".join(parts)
+
+
+def collection_wkb(wkbs):
+    # WKBの並びを GeometryCollection のWKBにまとめる
+    return struct.pack("<BII", 1, WKB_GEOMETRYCOLLECTION, len(wkbs)) + b"".join(wkbs)
+
+
+def grid_cells(rings, cell_size):
+    # Polygon の外接矩形と重なる格子セルの矩形 (west, south, east, north) を返す
+    lons = [point[0] for point in rings[0]]
+    lats = [point[1] for point in rings[0]]
+    x0 = math.floor(min(lons) / cell_size)
+    x1 = math.floor(max(lons) / cell_size)
+    y0 = math.floor(min(lats) / cell_size)
+    y1 = math.floor(max(lats) / cell_size)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield (
+                round(x * cell_size, 9),
+                round(y * cell_size, 9),
+                round((x + 1) * cell_size, 9),
+                round((y + 1) * cell_size, 9),
+            )
+
+
+def box_wkb(west, south, east, north):
+    ring = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+    return polygon_wkb([ring])
+
+
+def geometry_polygons(geometry):
+    # Polygon / MultiPolygon を Polygon 座標の並びとして返す
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+
+
+class PolygonGridIndex:
+    # 多角形の和集合に点が含まれるかを、DBを使わずに判定する格子索引
+    # 各セルに、セルと重なる辺と、セル中心の内外を持たせる。点の判定は
+    # 点からセル中心までの水平・垂直の2本の線分と交わる辺の数の偶奇で行う。
+    # 隣接する多角形が共有する辺は偶奇に影響しないので取り除く (海岸線だけが残る)
+    CACHE_VERSION = 1
+
+    def __init__(self, cell_size=0.02):
+        self.cell_size = cell_size
+        self.edges = defaultdict(lambda: array("d"))  # セル -> [x1, y1, x2, y2, ...]
+        self.crossings = defaultdict(list)  # 行 -> 行の中心線と辺の交点の経度
+        self.inside = set()  # 中心が内側のセル
+        self.mixed = {}  # 辺を持つセル -> array("d", [x1, y1, x2, y2, ...])
+
+    def add_polygon(self, rings):
+        size = self.cell_size
+        edges = self.edges
+        for ring in rings:
+            xs = [point[0] for point in ring]
+            ys = [point[1] for point in ring]
+            cols = [math.floor(x / size) for x in xs]
+            rows = [math.floor(y / size) for y in ys]
+            for k in range(len(ring) - 1):
+                x1, y1, x2, y2 = xs[k], ys[k], xs[k + 1], ys[k + 1]
+                if x1 == x2 and y1 == y2:
+                    continue
+                edge = (x1, y1, x2, y2)
+                # 辺の外接矩形と重なるセル (頂点が密なので大半は1セル)
+                i0, i1 = sorted((cols[k], cols[k + 1]))
+                j0, j1 = sorted((rows[k], rows[k + 1]))
+                if i0 == i1 and j0 == j1:
+                    edges[(i0, j0)].extend(edge)
+                else:
+                    for i in range(i0, i1 + 1):
+                        for j in range(j0, j1 + 1):
+                            edges[(i, j)].extend(edge)
+                # 行の中心線 (j + 0.5) * size との交点 (半開区間で頂点の重複を避ける)
+                for j in range(j0, j1 + 1):
+                    yc = (j + 0.5) * size
+                    if (y1 <= yc < y2) or (y2 <= yc < y1):
+                        self.crossings[j].append(x1 + (yc - y1) * (x2 - x1) / (y2 - y1))
+
+    def build(self):
+        size = self.cell_size
+        # 行ごとに中心線上の内側の区間を求め、中心がその区間にあるセルを内側とする
+        for j, xs in self.crossings.items():
+            xs.sort()
+            for x_in, x_out in zip(xs[0::2], xs[1::2]):
+                i0 = math.ceil(x_in / size - 0.5)
+                i1 = math.ceil(x_out / size - 0.5)
+                self.inside.update((i, j) for i in range(i0, i1))
+        self.crossings.clear()
+        for cell, edges in self.edges.items():
+            # 2回現れる辺 (隣接する多角形の境界) を取り除く
+            counts = defaultdict(int)
+            for k in range(0, len(edges), 4):
+                x1, y1, x2, y2 = edges[k : k + 4]
+                key = (x1, y1, x2, y2) if (x1, y1) < (x2, y2) else (x2, y2, x1, y1)
+                counts[key] += 1
+            coords = array("d")
+            for key, n in counts.items():
+                if n % 2:
+                    coords.extend(key)
+            if coords:
+                self.mixed[cell] = coords
+        self.edges.clear()
+
+    def contains(self, lon, lat):
+        size = self.cell_size
+        cell = (math.floor(lon / size), math.floor(lat / size))
+        inside = cell in self.inside
+        coords = self.mixed.get(cell)
+        if coords is None:
+            return inside
+        xc = (cell[0] + 0.5) * size
+        yc = (cell[1] + 0.5) * size
+        for k in range(0, len(coords), 4):
+            x1, y1, x2, y2 = coords[k : k + 4]
+            # 点 -> (xc, lat) の水平線分
+            if (y1 <= lat < y2) or (y2 <= lat < y1):
+                x = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+                if min(lon, xc) <= x < max(lon, xc):
+                    inside = not inside
+            # (xc, lat) -> セル中心の垂直線分
+            if (x1 <= xc < x2) or (x2 <= xc < x1):
+                y = y1 + (xc - x1) * (y2 - y1) / (x2 - x1)
+                if min(lat, yc) <= y < max(lat, yc):
+                    inside = not inside
+        return inside
+
+    def save(self, path, source_key=None):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {
+                    "version": self.CACHE_VERSION,
+                    "source": source_key,
+                    "cell_size": self.cell_size,
+                    "inside": self.inside,
+                    "mixed": self.mixed,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source_key=None):
+        # キャッシュが無いか、作成元や形式が異なれば None
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            return None
+        if data.get("version") != cls.CACHE_VERSION or data["source"] != source_key:
+            return None
+        index = cls(data["cell_size"])
+        index.inside = data["inside"]
+        index.mixed = data["mixed"]
+        return index
+
+
+def _unit_vector(lon, lat):
+    # 経度・緯度を単位球面上の3次元座標に変換
+    lam = math.radians(lon)
+    phi = math.radians(lat)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+
+
+class PointKDTree:
+    # 点 (経度・緯度) の最近傍探索。単位球面上の3次元座標で KD-tree を作るので、
+    # 弦の長さの大小が球面距離 (ST_Distance_Sphere) の大小と一致する。
+    # 木は配列に埋め込み、nodes[lo:hi] の中央の要素をその範囲の節点とする
+    def __init__(self, points):
+        # points: (経度, 緯度, 値) の並び
+        self.nodes = [(_unit_vector(lon, lat), value) for lon, lat, value in points]
+        stack = [(0, len(self.nodes), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo <= 1:
+                continue
+            self.nodes[lo:hi] = sorted(self.nodes[lo:hi], key=lambda n: n[0][axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, (axis + 1) % 3))
+            stack.append((mid + 1, hi, (axis + 1) % 3))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def nearest(self, lon, lat, radius_m):
+        # radius_m 以内で最も近い点の (値, 距離[m])、無ければ None
+        q = _unit_vector(lon, lat)
+        chord = 2 * math.sin(min(radius_m / EARTH_RADIUS_M, math.pi) / 2)
+        best_d2 = chord * chord
+        best = None
+        stack = [(0, len(self.nodes), 0, 0.0)]
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            if lo >= hi or bound > best_d2:
+                continue
+            mid = (lo + hi) // 2
+            p, value = self.nodes[mid]
+            d2 = (q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2 + (q[2] - p[2]) ** 2
+            if d2 <= best_d2:
+                best_d2 = d2
+                best = value
+            diff = q[axis] - p[axis]
+            near, far = (
+                ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            )
+            # 遠い側は分割面までの距離が現在の最良より近い場合だけ調べる
+            stack.append((*far, (axis + 1) % 3, diff * diff))
+            stack.append((*near, (axis + 1) % 3, 0.0))
+        if best is None:
+            return None
+        return best, 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(best_d2) / 2))
+
+
+def load_boundary_index(geojson_path, cache_path=None, cell_size=0.02):
+    # 行政区域境界のGeoJSON (またはZIP) から PolygonGridIndex を作る
+    # cache_path があれば、作成元のファイルが同じ限りそれを読み込む
+    stat = os.stat(geojson_path)
+    source_key = (os.path.abspath(geojson_path), stat.st_size, stat.st_mtime_ns)
+    if cache_path:
+        index = PolygonGridIndex.load(cache_path, source_key)
+        if index and index.cell_size == cell_size:
+            return index
+    index = PolygonGridIndex(cell_size)
+    with open_geojson(geojson_path) as f:
+        for feature in iter_features(f):
+            for rings in geometry_polygons(feature["geometry"]):
+                index.add_polygon(rings)
+    index.build()
+    if cache_path:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        index.save(cache_path, source_key)
+    return index
+
+
+# __END__
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 行を一定数ごとのチャンクに分け、複数のMySQL接続で並列に登録する
+# (import_pois.py, import_csv.py で共用)
+# チャンクごとにコミットするので、全体は1トランザクションにならない。
+# 再試行しても失敗したチャンクがあれば以降のチャンクは投入せずに終わり、
+# それまでにコミットしたチャンクはテーブルに残る (呼び出し側は終了コード1で
+# 終わり、取込記録も残さないので、再実行で登録し直す)
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mysql.connector
+
+# 再試行するエラー (デッドロック、ロック待ちタイムアウト、接続断)
+RETRY_ERRNOS = {1205, 1213, 2006, 2013}
+# 接続を張り直すエラー (MySQL server has gone away, Lost connection)
+RECONNECT_ERRNOS = {2006, 2013}
+
+
+def connect_db(**kwargs):
+    my_cnf = Path(sys.prefix).parent / ".my.cnf"
+    return mysql.connector.connect(
+        option_files=str(my_cnf),
+        autocommit=False,
+        **kwargs,
+    )
+
+
+class ChunkedLoader:
+    # sql: executemany する INSERT 文
+    # workers: 接続数, batch_size: 1チャンク(1トランザクション)の行数
+    # retries: チャンクごとの再試行回数
+    def __init__(self, sql, workers=4, batch_size=10000, retries=3, label=None):
+        self.sql = sql
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.label = label or "rows"
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        # 接続断のあとだけ張り直す (チャンクごとの確認の往復はしない)
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = connect_db()
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def _load_chunk(self, chunk):
+        # 登録した行数を返す。再試行しても失敗したら例外
+        for attempt in range(self.retries + 1):
+            conn = self._connection()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.executemany(self.sql, chunk)
+                conn.commit()
+                return len(chunk)
+            except mysql.connector.Error as e:
+                if e.errno in RECONNECT_ERRNOS:
+                    self.local.conn = None  # 接続断: 次回に再接続
+                else:
+                    try:
+                        conn.rollback()
+                    except mysql.connector.Error:
+                        self.local.conn = None
+                if e.errno not in RETRY_ERRNOS or attempt == self.retries:
+                    raise
+                time.sleep(1 << attempt)
+
+    def _chunks(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def load(self, rows):
+        # rows を登録し、(登録した行数, 失敗したチャンク数) を返す
+        # 結果とエラーは入力の順に報告する。失敗したら残りの行は読まない
+        count = 0
+        n_failed = 0
+        pending = []  # (開始行, future) を投入順に保持
+
+        def report(first_row, future):
+            nonlocal count, n_failed
+            try:
+                count += future.result()
+                print(f"Inserted {count} {self.label}")
+            except mysql.connector.Error as e:
+                n_failed += 1
+                print(f"MySQL Error in rows {first_row}-: {e}", file=sys.stderr)
+
+        first_row = 1
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk in self._chunks(rows):
+                if n_failed:
+                    break
+                pending.append((first_row, executor.submit(self._load_chunk, chunk)))
+                first_row += len(chunk)
+                # 読み込みが先行しすぎないよう、投入済みのチャンク数を抑える
+                while len(pending) > self.workers:
+                    report(*pending.pop(0))
+            while pending:
+                report(*pending.pop(0))
+        self.close()
+        return count, n_failed
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.close()
+                except mysql.connector.Error:
+                    pass
+            self.connections = []
+
+
+# __END__